@@ -4,7 +4,12 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
-from . import bus, motion_report
+from . import bus, motion_report, shaper_calibrate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ADXL345 registers
 REG_DEVID = 0x00
@@ -26,6 +31,9 @@ SET_FIFO_CTL = 0x90
 FREEFALL_ACCEL = 9.80665 * 1000.
 SCALE = 0.0039 * FREEFALL_ACCEL # 3.9mg/LSB * Earth gravity in mm/s**2
 
+# Maximum duration of the samples collected by an internal client
+MAX_STREAM_TIME = 10000 * 0.100
+
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
@@ -100,6 +108,76 @@ class ADXL345QueryHelper:
         write_proc.daemon = True
         write_proc.start()
 
+# Helper class to obtain measurements as a numpy array.  The samples
+# are streamed into a growing array (and, for the resonance tests, into
+# the PSD) as they arrive.
+class ADXL345StreamHelper:
+    def __init__(self, printer, data_rate, want_psd=False):
+        self.printer = printer
+        print_time = printer.lookup_object('toolhead').get_last_move_time()
+        self.request_start_time = self.request_end_time = print_time
+        # Same limit as motion_report.InternalDumpClient (10000 updates)
+        self.max_count = int(data_rate * MAX_STREAM_TIME)
+        self.buffer = numpy.empty((data_rate * 4, 4))
+        self.count = 0
+        self.is_done = False
+        self.psd_acc = None
+        if want_psd:
+            self.psd_acc = shaper_calibrate.PSDAccumulator(numpy, data_rate)
+    # APIDumpHelper client interface (the samples are passed by
+    # add_samples() instead of the messages)
+    def is_closed(self):
+        return self.is_done
+    def send(self, msg):
+        pass
+    def add_samples(self, samples):
+        if self.is_done:
+            return
+        if samples[0, 0] < self.request_start_time:
+            samples = samples[samples[:, 0] >= self.request_start_time]
+        count = self.count
+        new_count = min(count + len(samples), self.max_count)
+        if new_count > len(self.buffer):
+            size = min(max(new_count, 2 * len(self.buffer)), self.max_count)
+            buffer = numpy.empty((size, 4))
+            buffer[:count] = self.buffer[:count]
+            self.buffer = buffer
+        self.buffer[count:new_count] = samples[:new_count - count]
+        self.count = new_count
+        if self.psd_acc is not None:
+            self.psd_acc.update(self.buffer[:new_count])
+        if new_count >= self.max_count:
+            # Avoid filling up memory with too many samples
+            self.is_done = True
+    def finish_measurements(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        self.request_end_time = toolhead.get_last_move_time()
+        toolhead.wait_moves()
+        self.is_done = True
+    def has_valid_samples(self):
+        return len(self.get_samples()) > 0
+    def get_samples(self):
+        samples = self.buffer[:self.count]
+        end = numpy.searchsorted(samples[:, 0], self.request_end_time,
+                                 side='right')
+        return samples[:end]
+    def get_psd_accumulator(self):
+        return self.psd_acc
+    def write_to_file(self, filename):
+        def write_impl():
+            try:
+                # Try to re-nice writing process
+                os.nice(20)
+            except:
+                pass
+            f = open(filename, "w")
+            f.write("#time,accel_x,accel_y,accel_z\n")
+            numpy.savetxt(f, self.get_samples(), fmt="%.6f", delimiter=",")
+            f.close()
+        write_proc = multiprocessing.Process(target=write_impl)
+        write_proc.daemon = True
+        write_proc.start()
+
 # Helper class for G-Code commands
 class ADXLCommandHelper:
     def __init__(self, config, chip):
@@ -153,7 +231,7 @@ class ADXLCommandHelper:
         self.printer.lookup_object('toolhead').dwell(1.)
         aclient.finish_measurements()
         values = aclient.get_samples()
-        if not values:
+        if not len(values):
             raise gcmd.error("No adxl345 measurements found")
         _, accel_x, accel_y, accel_z = values[-1]
         gcmd.respond_info("adxl345 values (x, y, z): %.6f, %.6f, %.6f"
@@ -240,6 +318,7 @@ class ADXL345:
         # Measurement storage (accessed from background thread)
         self.lock = threading.Lock()
         self.raw_samples = []
+        self.stream_clients = []
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
         self.mcu = mcu = self.spi.get_mcu()
@@ -328,6 +407,48 @@ class ADXL345:
         self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
         del samples[count:]
         return samples
+    def _extract_samples_array(self, raw_samples):
+        # Same as _extract_samples(), decoding all messages at once.
+        # numpy.round() scales by 1e6 in binary floating point, so values
+        # close to a halfway case may differ from round() by 1e-6.
+        np = numpy
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        seqs = []
+        counts = []
+        data = []
+        for params in raw_samples:
+            seq_diff = (last_sequence - params['sequence']) & 0xffff
+            seq_diff -= (seq_diff & 0x8000) << 1
+            seqs.append(last_sequence - seq_diff)
+            d = params['data']
+            count = len(d) // BYTES_PER_SAMPLE
+            counts.append(count)
+            data.append(bytes(d[:count * BYTES_PER_SAMPLE]))
+        d = np.frombuffer(b"".join(data), dtype=np.uint8).astype(np.int32)
+        xlow, ylow, zlow, xzhigh, yzhigh = d.reshape(-1, BYTES_PER_SAMPLE).T
+        # Chip clock of every sample
+        counts = np.array(counts)
+        starts = np.cumsum(counts) - counts
+        sample_cdiff = (np.arange(len(xlow)) - np.repeat(starts, counts)
+                        + np.repeat(np.array(seqs) * SAMPLES_PER_BLOCK
+                                    - chip_base, counts))
+        valid = (yzhigh & 0x80) == 0
+        self.last_error_count += len(valid) - int(np.count_nonzero(valid))
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        raw_xyz = (rx[valid], ry[valid], rz[valid])
+        samples = np.empty((len(raw_xyz[0]), 4))
+        samples[:, 0] = np.round(time_base + sample_cdiff[valid] * inv_freq, 6)
+        samples[:, 1] = np.round(raw_xyz[x_pos] * x_scale, 6)
+        samples[:, 2] = np.round(raw_xyz[y_pos] * y_scale, 6)
+        samples[:, 3] = np.round(raw_xyz[z_pos] * z_scale, 6)
+        self.clock_sync.set_last_chip_clock(
+            seqs[-1] * SAMPLES_PER_BLOCK + counts[-1] - 1)
+        return samples
     def _update_clock(self, minclock=0):
         # Query current state
         for retry in range(5):
@@ -416,11 +537,26 @@ class ADXL345:
             self.raw_samples = []
         if not raw_samples:
             return {}
-        samples = self._extract_samples(raw_samples)
-        if not samples:
+        if numpy is None:
+            samples = self._extract_samples(raw_samples)
+            if not samples:
+                return {}
+            return {'data': samples, 'errors': self.last_error_count,
+                    'overflows': self.last_limit_count}
+        samples = self._extract_samples_array(raw_samples)
+        if not len(samples):
             return {}
-        return {'data': samples, 'errors': self.last_error_count,
-                'overflows': self.last_limit_count}
+        self.stream_clients = [c for c in self.stream_clients
+                               if not c.is_closed()]
+        for client in self.stream_clients:
+            client.add_samples(samples)
+        msg = {'errors': self.last_error_count,
+               'overflows': self.last_limit_count}
+        if any([not isinstance(c, ADXL345StreamHelper)
+                for c in self.api_dump.clients]):
+            # Other clients get the samples as lists
+            msg['data'] = samples.tolist()
+        return msg
     def _api_startstop(self, is_start):
         if is_start:
             self._start_measurements()
@@ -430,9 +566,14 @@ class ADXL345:
         self.api_dump.add_client(web_request)
         hdr = ('time', 'x_acceleration', 'y_acceleration', 'z_acceleration')
         web_request.send({'header': hdr})
-    def start_internal_client(self):
-        cconn = self.api_dump.add_internal_client()
-        return ADXL345QueryHelper(self.printer, cconn)
+    def start_internal_client(self, want_psd=False):
+        if numpy is None:
+            cconn = self.api_dump.add_internal_client()
+            return ADXL345QueryHelper(self.printer, cconn)
+        client = ADXL345StreamHelper(self.printer, self.data_rate, want_psd)
+        self.api_dump.add_internal_client(client)
+        self.stream_clients.append(client)
+        return client
 
 def load_config(config):
     return ADXL345(config)
@@ -7,6 +7,11 @@
 import logging, math, json, collections, chelper
 from . import probe
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 PROFILE_VERSION = 1
 PROFILE_OPTIONS = {
     'min_x': float, 'max_x': float, 'min_y': float, 'max_y': float,
@@ -31,10 +36,6 @@ def within(coord, min_c, max_c, tol=0.0):
 def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
 
-# Linear interpolation between two values
-def lerp(t, v0, v1):
-    return (1. - t) * v0 + t * v1
-
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -106,7 +107,7 @@ class BedMesh:
         self.base_fade_target = config.getfloat('fade_target', None)
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
-        self.splitter = MoveSplitter(config, self.gcode)
+        self.splitter = MoveSplitter(config)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -209,25 +210,24 @@ class BedMesh:
                     % (z, self.fade_target))
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
         else:
-            long_move = False
-            move_distance = math.sqrt((newpos[0] - self.last_position[0])**2 + (newpos[1] - self.last_position[1])**2)
+            split_moves = self.splitter.split_move(
+                self.last_position, newpos, factor)
+            move_distance = math.sqrt(
+                (newpos[0] - self.last_position[0])**2
+                + (newpos[1] - self.last_position[1])**2)
             if move_distance > 10:
-                long_move = True
-            self.splitter.build_move(self.last_position, newpos, factor)
-            while not self.splitter.traverse_complete:
-                split_move = self.splitter.split()
-                if long_move:
-                    split_offset = self.ffi_lib.get_offset(0.0, 0.0, self.last_position[0], self.last_position[1], newpos[0], newpos[1], split_move[0], split_move[1], self.delta_split_offset, move_distance)
-                    split_offset = split_offset * factor
-                    #logging.info("split_offset is %s", str(split_offset))
-                    split_move = list(split_move)
-                    split_move[2] -= split_offset
-                    split_move = tuple(split_move)
-                if split_move:
-                    self.toolhead.move(split_move, speed)
-                else:
-                    raise self.gcode.error(
-                        "Mesh Leveling: Error splitting move ")
+                #flsun add, correct the height of long moves
+                get_offset = self.ffi_lib.get_offset
+                lx, ly = self.last_position[0], self.last_position[1]
+                for split_move in split_moves:
+                    split_offset = get_offset(
+                        0.0, 0.0, lx, ly, newpos[0], newpos[1],
+                        split_move[0], split_move[1],
+                        self.delta_split_offset, move_distance)
+                    split_move[2] -= split_offset * factor
+            toolhead_move = self.toolhead.move
+            for split_move in split_moves:
+                toolhead_move(split_move, speed)
         self.last_position[:] = newpos
     def get_point_line_distance(self, point, line_s, line_e):
         point_x = point[0]
@@ -809,72 +809,56 @@ class BedMeshCalibrate:
 
 
 class MoveSplitter:
-    def __init__(self, config, gcode):
+    def __init__(self, config):
         self.split_delta_z = config.getfloat(
             'split_delta_z', .001, minval=0.0001)
         self.move_check_distance = config.getfloat(
             'move_check_distance', 5., minval=3.)
         self.z_mesh = None
         self.fade_offset = 0.
-        self.gcode = gcode
     def initialize(self, mesh, fade_offset):
         self.z_mesh = mesh
         self.fade_offset = fade_offset
-    def build_move(self, prev_pos, next_pos, factor):
-        self.prev_pos = tuple(prev_pos)
-        self.next_pos = tuple(next_pos)
-        self.current_pos = list(prev_pos)
-        self.z_factor = factor
-        self.z_offset = self._calc_z_offset(prev_pos)
-        self.traverse_complete = False
-        self.distance_checked = 0.
-        axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
-        self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
-        self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
-    def _calc_z_offset(self, pos):
-        z = self.z_mesh.calc_z(pos[0], pos[1])
-        offset = self.fade_offset
-        return self.z_factor * (z - offset) + offset
-    def _set_next_move(self, distance_from_prev):
-        t = distance_from_prev / self.total_move_length
-        if t > 1. or t < 0.:
-            raise self.gcode.error(
-                "bed_mesh: Slice distance is negative "
-                "or greater than entire move length")
-        for i in range(4):
-            if self.axis_move[i]:
-                self.current_pos[i] = lerp(
-                    t, self.prev_pos[i], self.next_pos[i])
-    def split(self):
-        if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
-            # end of move reached
-            self.current_pos[:] = self.next_pos
-            self.z_offset = self._calc_z_offset(self.current_pos)
-            # Its okay to add Z-Offset to the final move, since it will not be
-            # used again.
-            self.current_pos[2] += self.z_offset
-            self.traverse_complete = True
-            return self.current_pos
-        else:
-            # Traverse complete
-            return None
+    def split_move(self, prev_pos, next_pos, factor):
+        # Return the list of positions (with the z adjustment applied)
+        # that the move from prev_pos to next_pos is split into
+        calc_z = self.z_mesh.calc_z
+        fade_offset = self.fade_offset
+        axes_d = [next_pos[i] - prev_pos[i] for i in range(4)]
+        for i, d in enumerate(axes_d):
+            if isclose(d, 0., abs_tol=1e-10):
+                axes_d[i] = 0.
+        px, py, pz, pe = prev_pos
+        dx, dy, dz, de = axes_d
+        split_moves = []
+        if dx or dy:
+            # X and/or Y axis move, check the mesh along the move
+            move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
+            check_d = self.move_check_distance
+            split_delta_z = self.split_delta_z
+            z_offset = factor * (calc_z(px, py) - fade_offset) + fade_offset
+            dist = check_d
+            while dist < move_d:
+                t = dist / move_d
+                x = px + t * dx
+                y = py + t * dy
+                next_z = factor * (calc_z(x, y) - fade_offset) + fade_offset
+                if abs(next_z - z_offset) >= split_delta_z:
+                    z_offset = next_z
+                    split_moves.append(
+                        [x, y, pz + t * dz + z_offset, pe + t * de])
+                dist += check_d
+        # End of move
+        x, y, z, e = next_pos
+        z_offset = factor * (calc_z(x, y) - fade_offset) + fade_offset
+        split_moves.append([x, y, z + z_offset, e])
+        return split_moves
 
 
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.cell_coeffs = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offsets = [0., 0.]
@@ -895,6 +879,9 @@ class ZMesh:
             'bicubic': self._sample_bicubic,
             'direct': self._sample_direct
         }
+        if numpy is not None:
+            interpolation_algos['lagrange'] = self._sample_lagrange_numpy
+            interpolation_algos['bicubic'] = self._sample_bicubic_numpy
         self._sample = interpolation_algos.get(params['algo'])
         # Number of points to interpolate per segment
         mesh_x_pps = params['mesh_x_pps']
@@ -957,6 +944,7 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        self._build_cell_coeffs()
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
@@ -972,17 +960,36 @@ class ZMesh:
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
+    def _build_cell_coeffs(self):
+        # Bilinear coefficients of each mesh cell (row major), such that
+        # z = a + b*tx + c*ty + d*tx*ty within the cell
+        tbl = self.mesh_matrix
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00 = row0[xidx]
+                z01 = row0[xidx+1]
+                z10 = row1[xidx]
+                z11 = row1[xidx+1]
+                coeffs.append((z00, z01 - z00, z10 - z00,
+                               z11 - z10 - z01 + z00))
+        self.cell_coeffs = coeffs
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        coeffs = self.cell_coeffs
+        if coeffs is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        # Cell index and position inside the cell for both axes
+        tx = (x + self.mesh_offsets[0] - self.mesh_x_min) / self.mesh_x_dist
+        xidx = min(max(int(math.floor(tx)), 0), self.mesh_x_count - 2)
+        tx = min(max(tx - xidx, 0.), 1.)
+        ty = (y + self.mesh_offsets[1] - self.mesh_y_min) / self.mesh_y_dist
+        yidx = min(max(int(math.floor(ty)), 0), self.mesh_y_count - 2)
+        ty = min(max(ty - yidx, 0.), 1.)
+        a, b, c, d = coeffs[yidx * (self.mesh_x_count - 1) + xidx]
+        return a + b * tx + (c + d * tx) * ty
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -990,24 +997,6 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
@@ -1160,6 +1149,64 @@ class ZMesh:
         c = m1 * (t3 - 2*t2 + t)
         d = m2 * (t3 - t2)
         return a + b + c + d
+    # The lagrange and bicubic interpolations are linear in the probed
+    # points and separable, so with numpy the mesh is computed as
+    # y_weights * z_matrix * x_weights^T.  Each weight matrix has a row
+    # per mesh point and a column per probed point.
+    def _sample_numpy(self, z_matrix, x_weights, y_weights):
+        z = numpy.array(z_matrix, dtype=float)
+        self.mesh_matrix = y_weights.dot(z.dot(x_weights.T)).tolist()
+    def _set_probed_weights(self, weights, mult):
+        # Probed points are copied as is
+        probed = numpy.arange(weights.shape[1])
+        weights[probed * mult] = 0.
+        weights[probed * mult, probed] = 1.
+        return weights
+    def _lagrange_weights(self, lpts, coords, mult):
+        np = numpy
+        lpts = np.array(lpts)
+        diffs = np.array(coords)[:, np.newaxis] - lpts
+        pt_cnt = len(lpts)
+        weights = np.empty((len(coords), pt_cnt))
+        for i in range(pt_cnt):
+            others = np.arange(pt_cnt) != i
+            weights[:, i] = (np.prod(diffs[:, others], axis=1)
+                             / np.prod(lpts[i] - lpts[others]))
+        return self._set_probed_weights(weights, mult)
+    def _sample_lagrange_numpy(self, z_matrix):
+        xpts, ypts = self._get_lagrange_coords()
+        x_coords = [self.get_x_coordinate(i) for i in range(self.mesh_x_count)]
+        y_coords = [self.get_y_coordinate(i) for i in range(self.mesh_y_count)]
+        self._sample_numpy(
+            z_matrix, self._lagrange_weights(xpts, x_coords, self.x_mult),
+            self._lagrange_weights(ypts, y_coords, self.y_mult))
+    def _bicubic_weights(self, pt_cnt, mult, tension):
+        # Weights of the control points used by _get_x_ctl_pts(),
+        # _get_y_ctl_pts() and _cardinal_spline()
+        np = numpy
+        idx = np.arange((pt_cnt - 1) * mult + 1)
+        p1 = np.minimum(idx // mult, pt_cnt - 2)
+        p0 = np.maximum(p1 - 1, 0)
+        p2 = p1 + 1
+        p3 = np.minimum(p1 + 2, pt_cnt - 1)
+        t = (idx - p1 * mult) / float(mult)
+        t2 = t*t
+        t3 = t2*t
+        h10 = tension * (t3 - 2*t2 + t)
+        h11 = tension * (t3 - t2)
+        weights = np.zeros((len(idx), pt_cnt))
+        np.add.at(weights, (idx, p0), -h10)
+        np.add.at(weights, (idx, p1), 2*t3 - 3*t2 + 1 - h11)
+        np.add.at(weights, (idx, p2), -2*t3 + 3*t2 + h10)
+        np.add.at(weights, (idx, p3), h11)
+        return self._set_probed_weights(weights, mult)
+    def _sample_bicubic_numpy(self, z_matrix):
+        c = self.mesh_params['tension']
+        self._sample_numpy(
+            z_matrix,
+            self._bicubic_weights(self.mesh_params['x_count'], self.x_mult, c),
+            self._bicubic_weights(self.mesh_params['y_count'], self.y_mult, c))
+
 
 
 class ProfileManager:
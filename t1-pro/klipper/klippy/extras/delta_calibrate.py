@@ -3,7 +3,7 @@
 # Copyright (C) 2017-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, collections
+import math, logging, collections, random
 import mathutil
 from . import probe
 
@@ -30,6 +30,9 @@ MeasureRidgeRadius = 5. - .5
 # How much to prefer a distance measurement over a height measurement
 MEASURE_WEIGHT = 0.5
 
+# Maximum change of each parameter for the additional solver starts
+MULTI_START_RANGE = 1.
+
 # Convert distance measurements made on the calibration object to
 # 3-tuples of (actual_distance, stable_position1, stable_position2)
 def measurements_to_distances(measured_params, delta_params):
@@ -91,6 +94,16 @@ class DeltaCalibrate:
         self.probe_helper = probe.ProbePointsHelper(
             config, self.probe_finalize, default_points=points)
         self.probe_helper.minimum_points(3)
+        # Solver setup
+        solvers = {'coordinate_descent': 'coordinate_descent',
+                   'levenberg_marquardt': 'levenberg_marquardt'}
+        self.solver = config.getchoice('solver', solvers,
+                                       'coordinate_descent')
+        if self.solver == 'levenberg_marquardt' and mathutil.numpy is None:
+            logging.warning("delta_calibrate: numpy not available,"
+                            " using coordinate_descent")
+            self.solver = 'coordinate_descent'
+        self.multi_start = config.getint('multi_start', 1, minval=1)
         # Restore probe stable positions
         self.last_probe_positions = []
         for i in range(999):
@@ -173,29 +186,88 @@ class DeltaCalibrate:
         z_weight = 1.
         if distances:
             z_weight = len(distances) / (MEASURE_WEIGHT * len(probe_positions))
-        # Perform coordinate descent
-        def delta_errorfunc(params):
+        # Setup the error functions of the solvers
+        z_scale = math.sqrt(z_weight)
+        use_arrays = (mathutil.numpy is not None
+                      and hasattr(odp, 'get_positions_from_stable'))
+        if use_arrays:
+            np = mathutil.numpy
+            height_goals = np.array([z for z, spos in height_positions])
+            height_spos = [spos for z, spos in height_positions]
+            dist_goals = np.array([d for d, spos1, spos2 in distances])
+            dist_spos = ([spos1 for d, spos1, spos2 in distances]
+                         + [spos2 for d, spos1, spos2 in distances])
+        def delta_residuals(params):
             try:
                 # Build new delta_params for params under test
                 delta_params = orig_delta_params.new_calibration(params)
+                if use_arrays:
+                    # Calculate z height and distance errors of all points
+                    heights = delta_params.get_positions_from_stable(
+                        height_spos)[:, 2]
+                    res = (heights - height_goals) * z_scale
+                    if not distances:
+                        return res
+                    pos = delta_params.get_positions_from_stable(dist_spos)
+                    count = len(distances)
+                    d = np.sqrt(((pos[:count] - pos[count:])**2).sum(axis=1))
+                    return np.concatenate((res, d - dist_goals))
                 getpos = delta_params.get_position_from_stable
+                res = []
                 # Calculate z height errors
-                total_error = 0.
                 for z_offset, stable_pos in height_positions:
                     x, y, z = getpos(stable_pos)
-                    total_error += (z - z_offset)**2
-                total_error *= z_weight
+                    res.append((z - z_offset) * z_scale)
                 # Calculate distance errors
                 for dist, stable_pos1, stable_pos2 in distances:
                     x1, y1, z1 = getpos(stable_pos1)
                     x2, y2, z2 = getpos(stable_pos2)
                     d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
-                    total_error += (d - dist)**2
-                return total_error
+                    res.append(d - dist)
+                return res
             except ValueError:
+                res = [float('nan')] * (len(height_positions)
+                                        + len(distances))
+                if use_arrays:
+                    return np.array(res)
+                return res
+        def delta_errorfunc(params):
+            res = delta_residuals(params)
+            if use_arrays:
+                total_error = float(res.dot(res))
+            else:
+                total_error = sum([r*r for r in res])
+            if math.isnan(total_error):
                 return 9999999999999.9
-        new_params = mathutil.background_coordinate_descent(
-            self.printer, adj_params, params, delta_errorfunc)
+            return total_error
+        # Perform the calibration
+        def make_solver(start_params):
+            if self.solver == 'levenberg_marquardt':
+                return lambda: mathutil.levenberg_marquardt(
+                    adj_params, start_params, delta_residuals)
+            return lambda: mathutil.coordinate_descent_stats(
+                adj_params, start_params, delta_errorfunc)
+        # Additional starts use randomly shifted parameters
+        starts = [params]
+        rand = random.Random(0)
+        for i in range(self.multi_start - 1):
+            start_params = dict(params)
+            for param_name in adj_params:
+                start_params[param_name] += rand.uniform(-MULTI_START_RANGE,
+                                                         MULTI_START_RANGE)
+            starts.append(start_params)
+        results = mathutil.background_calls(
+            self.printer, [make_solver(p) for p in starts])
+        new_params, stats = min(results, key=(lambda r: r[1]['error']))
+        # The best result may come from a shifted start
+        initial_error = delta_errorfunc(params)
+        logging.info("delta_calibrate initial error: %.6f", initial_error)
+        self.gcode.respond_info(
+            "%s: error %.6f -> %.6f after %d iterations (%d evaluations,"
+            " %.1fs%s, best of %d starts)" % (
+                stats['solver'], initial_error, stats['error'],
+                stats['iterations'], stats['evaluations'], stats['duration'],
+                ["", ", not converged"][not stats['converged']], len(starts)))
         # Log and report results
         logging.info("Calculated delta_calibrate parameters: %s", new_params)
         new_delta_params = orig_delta_params.new_calibration(new_params)
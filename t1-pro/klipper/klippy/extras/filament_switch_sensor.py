@@ -4,8 +4,6 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
-import time
-import threading
 
 class RunoutHelper:
     def __init__(self, config):
@@ -146,8 +144,15 @@ class RunoutDebounceHelper:
 
     def __init__(self, config):
         self.runout_helper = RunoutHelper(config)
-        self.lock = threading.Lock()
+        self.reactor = self.runout_helper.reactor
+        self.debounce_interval = config.getfloat(
+            'debounce_interval', self.DEBOUNCE_INTERVAL, above=0.)
+        self.debounce_samples = config.getint(
+            'debounce_samples', self.DEBOUNCE_COUNT, minval=0)
         self.debounce_count = 0
+        self.debounce_timer = self.reactor.register_timer(
+            self._debounce_event)
+        self.is_debouncing = False
         self.runout_state = False
         self.locate_printing_gcode = None
         self.runout_helper.gcode.register_command("F108", self.cmd_F108, desc=self.cmd_F108_help)
@@ -163,10 +168,14 @@ class RunoutDebounceHelper:
             if self.locate_printing_gcode is not None:
                 self.locate_printing_gcode.restore_runing_info('RunoutDebounceHelper')
 
-    def _runout_check_thread(self, eventtime):
-        # 启动一个线程，避免阻塞其他线程，也避免调用delayed_gcode造成的排队延迟
-        t = threading.Thread(target=self.thread_debounce, args=(eventtime,))
-        t.start()
+    def _start_debounce(self, eventtime):
+        # 用reactor定时器消抖，不创建线程，也避免调用delayed_gcode造成的排队延迟
+        if self.is_debouncing:
+            logging.info("RunoutDebounceHelper debounce is running")
+            return
+        self.is_debouncing = True
+        self.debounce_count = 0
+        self.reactor.update_timer(self.debounce_timer, self.reactor.NOW)
 
     def _runout_event_handler(self, eventtime):
         self.runout_state = True
@@ -177,41 +186,31 @@ class RunoutDebounceHelper:
             self.runout_helper.gcode.run_script(cmd)
         except Exception:
             logging.exception("Script running error")
-    # 消抖线程；
-    def thread_debounce(self, eventtime):
-        if self.lock.acquire(blocking=False):
-            while True:
-                # 如果又检测到料，则判断为误判，取消后续动作
-                if self.runout_helper.filament_present:
-                    logging.info("touch by mistake, no shortage of filament")
-
-                    self.runout_helper.reactor.register_async_callback((lambda e, s=self, d=self.debounce_count:
-                                                                        s._exec_gcode(
-                                                                            f"M117 not filament runout!")
-                                                                        ))
-                    self.runout_helper.min_event_systime = self.runout_helper.reactor.monotonic() + self.runout_helper.event_delay
-                    break
-                else:
-                    # 检测到缺料，则定期发送状态消息
-                    logging.info("RunoutDebounceHelper trigger,debounce_count=%d" % self.debounce_count)
-                    self.runout_helper.reactor.register_async_callback((lambda e, s=self, d=self.debounce_count:
-                                                                        s._exec_gcode(
-                                                                            f"M117 now num is {d}")
-                                                                        ))
-                    # 达到检测次数，则调用断料执行脚本
-                    if self.debounce_count >= self.DEBOUNCE_COUNT:
-                        self.runout_helper.reactor.register_async_callback(
-                            self._runout_event_handler)
-                        break
-
-                    self.debounce_count += 1
-                    time.sleep(self.DEBOUNCE_INTERVAL)
-
+    def _finish_debounce(self, msg):
+        # 消抖过程只在结束时发送一次状态消息
+        self.is_debouncing = False
+        self.reactor.register_callback(
+            (lambda e, s=self, m=msg: s._exec_gcode("M117 " + m)))
+        logging.info("RunoutDebounceHelper debounce is finished")
+        return self.reactor.NEVER
+    # 消抖定时器；每隔debounce_interval采样一次断料开关
+    def _debounce_event(self, eventtime):
+        # 如果又检测到料，则判断为误判，取消后续动作
+        if self.runout_helper.filament_present:
+            logging.info("touch by mistake, no shortage of filament, debounce_count=%d" % self.debounce_count)
+            self.runout_helper.min_event_systime = eventtime + self.runout_helper.event_delay
             self.debounce_count = 0
-            logging.info("RunoutDebounceHelper debounce thread is finished")
-            self.lock.release()
-        else:
-            logging.info("RunoutDebounceHelper debounce thread is running")
+            return self._finish_debounce("not filament runout!")
+        # 达到检测次数，则调用断料执行脚本
+        if self.debounce_count >= self.debounce_samples:
+            logging.info("RunoutDebounceHelper trigger,debounce_count=%d" % self.debounce_count)
+            msg = "now num is %d" % (self.debounce_count,)
+            self.debounce_count = 0
+            res = self._finish_debounce(msg)
+            self.reactor.register_callback(self._runout_event_handler)
+            return res
+        self.debounce_count += 1
+        return eventtime + self.debounce_interval
 
     def note_filament_present(self, et, is_filament_present, lazy=True):
         if lazy and is_filament_present == self.runout_helper.filament_present:
@@ -249,7 +248,7 @@ class RunoutDebounceHelper:
             # 检测到断料动作
             self.runout_helper.min_event_systime = self.runout_helper.reactor.NEVER
             logging.info("Filament Sensor %s: runout event detected, Time %.2f" % (self.runout_helper.name, eventtime))
-            self.runout_helper.reactor.register_callback(self._runout_check_thread)
+            self._start_debounce(eventtime)
 
     def get_status(self, eventtime):
         res = dict(self.runout_helper.get_status(eventtime))
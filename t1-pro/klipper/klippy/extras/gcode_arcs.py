@@ -8,7 +8,8 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
 
-# Coordinates created by this are converted into G1 commands.
+# Coordinates created by this are queued through gcode_move as a batch
+# of G1 equivalent moves.
 #
 # note: only IJ version available
 
@@ -16,11 +17,18 @@ class ArcSupport:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1., above=0.0)
+        # When set, the segment length follows the arc radius so that no
+        # chord deviates more than this from the arc (never shorter than
+        # the resolution)
+        self.max_chord_error = config.getfloat('max_chord_error', 0.,
+                                               minval=0.)
 
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("G2", self.cmd_G2)
         self.gcode.register_command("G3", self.cmd_G3)
+        self.gcode.register_fast_command("G2", self.fast_G2)
+        self.gcode.register_fast_command("G3", self.fast_G3)
 
     def cmd_G2(self, gcmd):
         self._cmd_inner(gcmd, True)
@@ -28,6 +36,28 @@ class ArcSupport:
     def cmd_G3(self, gcmd):
         self._cmd_inner(gcmd, False)
 
+    def fast_G2(self, params):
+        return self._fast_inner(params, True)
+
+    def fast_G3(self, params):
+        return self._fast_inner(params, False)
+
+    def _fast_inner(self, params, clockwise):
+        # Lines with errors are left to the regular handler to report
+        if ('R' in params or not (params.get('I') or params.get('J'))
+            or params.get('F', 1.) <= 0.):
+            return False
+        gcodestatus = self.gcode_move.get_status()
+        if not gcodestatus['absolute_coordinates']:
+            return False
+        currentPos = gcodestatus['gcode_position']
+        target = [params.get('X', currentPos[0]),
+                  params.get('Y', currentPos[1]),
+                  params.get('Z', currentPos[2])]
+        self._move_arc(gcodestatus, target,
+                       [params.get('I', 0.), params.get('J', 0.)],
+                       params.get('E'), params.get('F'), clockwise)
+
     def _cmd_inner(self, gcmd, clockwise):
         gcodestatus = self.gcode_move.get_status()
         if not gcodestatus['absolute_coordinates']:
@@ -45,34 +75,45 @@ class ArcSupport:
         if not asI and not asJ:
             raise gcmd.error("G2/G3 neither I nor J given")
         asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
+        asF = gcmd.get_float("F", None, above=0.)
+
+        self._move_arc(gcodestatus, [asX, asY, asZ], [asI, asJ], asE, asF,
+                       clockwise)
 
+    def _move_arc(self, gcodestatus, targetPos, offset, asE, asF, clockwise):
         # Build list of linear coordinates to move to
-        coords = self.planArc(currentPos, [asX, asY, asZ], [asI, asJ],
-                              clockwise)
-        e_per_move = e_base = 0.
+        currentPos = gcodestatus['gcode_position']
+        coords = self.planArc(currentPos, targetPos, offset, clockwise)
+        e_values = None
         if asE is not None:
+            e_base = 0.
             if gcodestatus['absolute_extrude']:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / len(coords)
-
-        # Convert coords into G1 commands
-        for coord in coords:
-            g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
             if e_per_move:
-                g1_params['E'] = e_base + e_per_move
                 if gcodestatus['absolute_extrude']:
-                    e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+                    e_values = [e_base + e_per_move * i
+                                for i in range(1, len(coords) + 1)]
+                else:
+                    e_values = [e_per_move] * len(coords)
+
+        self.gcode_move.move_segments(coords, e_values, asF)
+
+    def _segment_length(self, radius):
+        seg_len = self.mm_per_arc_segment
+        chord_error = self.max_chord_error
+        if chord_error and radius > chord_error:
+            # Chord length with a sagitta of max_chord_error
+            seg_len = max(seg_len, 2. * math.sqrt(
+                chord_error * (2. * radius - chord_error)))
+        return seg_len
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
     #
     # The arc is approximated by generating many small linear segments.
     # The length of each segment is configured in MM_PER_ARC_SEGMENT
+    # (or derived from the radius and max_chord_error)
     # Arcs smaller then this value, will be a Line only
     def planArc(self, currentPos, targetPos, offset, clockwise):
         # todo: sometimes produces full circles
@@ -111,21 +152,22 @@ class ArcSupport:
             mm_of_travel = math.hypot(flat_mm, linear_travel)
         else:
             mm_of_travel = math.fabs(flat_mm)
-        segments = max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
+        segments = max(1., math.floor(mm_of_travel
+                                      / self._segment_length(radius)))
 
         # Generate coordinates
         theta_per_segment = angular_travel / segments
         linear_per_segment = linear_travel / segments
+        cP, cQ, cZ = center_P, center_Q, currentPos[Z_AXIS]
+        oP, oQ = offset
         coords = []
         for i in range(1, int(segments)):
-            dist_Z = i * linear_per_segment
-            cos_Ti = math.cos(i * theta_per_segment)
-            sin_Ti = math.sin(i * theta_per_segment)
-            r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
-            r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
-
-            c = [center_P + r_P, center_Q + r_Q, currentPos[Z_AXIS] + dist_Z]
-            coords.append(c)
+            theta = i * theta_per_segment
+            cos_Ti = math.cos(theta)
+            sin_Ti = math.sin(theta)
+            coords.append((cP + (-oP * cos_Ti + oQ * sin_Ti),
+                           cQ + (-oP * sin_Ti - oQ * cos_Ti),
+                           cZ + i * linear_per_segment))
 
         coords.append(targetPos)
         return coords
@@ -0,0 +1,201 @@
+# Sidecar index of layer and object offsets in a gcode file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, json, bisect, logging, multiprocessing, traceback
+import queuelogger
+
+INDEX_VERSION = 1
+# Window searched forward for an object start when resuming (matches the
+# read size used by the original linear scan)
+OBJECT_SEARCH_WINDOW = 8192
+
+def index_filename(gcode_path):
+    dirname, fname = os.path.split(gcode_path)
+    return os.path.join(dirname, ".%s.index" % (fname,))
+
+def _file_signature(gcode_path):
+    st = os.stat(gcode_path)
+    return st.st_size, int(st.st_mtime)
+
+
+######################################################################
+# Index building
+######################################################################
+
+def _parse_float(word):
+    try:
+        return float(word[1:])
+    except ValueError:
+        return None
+
+# Scan a gcode file once and record layer changes (first extrusion at a
+# new maximum height) and EXCLUDE_OBJECT_START/END offsets.
+def build_index(gcode_path):
+    size, mtime = _file_signature(gcode_path)
+    layers = []
+    object_starts = []
+    object_ends = []
+    absolute_coord = absolute_extrude = True
+    z = e = filament = 0.
+    layer_z = None
+    z_move = (0, 0., 0, 0., 0.)
+    offset = line_no = 0
+    with open(gcode_path, 'rb') as f:
+        for raw in f:
+            line_offset = offset
+            offset += len(raw)
+            line_no += 1
+            line = raw.lstrip()
+            if not line or line[:1] == b';':
+                continue
+            if line.startswith(b'EXCLUDE_OBJECT_'):
+                parts = line.split(b';', 1)[0].split()
+                name = ""
+                for part in parts[1:]:
+                    if part.upper().startswith(b'NAME='):
+                        name = part[5:].decode('utf-8', 'replace').upper()
+                if parts[0] == b'EXCLUDE_OBJECT_START':
+                    object_starts.append((line_offset, name))
+                elif parts[0] == b'EXCLUDE_OBJECT_END':
+                    object_ends.append((line_offset, name))
+                continue
+            words = line.split(b';', 1)[0].upper().split()
+            if not words:
+                continue
+            cmd = words[0]
+            if cmd in (b'G1', b'G0'):
+                new_e = None
+                for word in words[1:]:
+                    axis = word[:1]
+                    if axis == b'Z':
+                        v = _parse_float(word)
+                        if v is not None:
+                            z = v if absolute_coord else z + v
+                            z_move = (line_offset, z, line_no - 1, e,
+                                      filament)
+                    elif axis == b'E':
+                        new_e = _parse_float(word)
+                if new_e is None:
+                    continue
+                if not absolute_coord or not absolute_extrude:
+                    new_e += e
+                delta = new_e - e
+                e = new_e
+                filament += delta
+                if delta > 0. and (layer_z is None or z > layer_z):
+                    layer_z = z
+                    layers.append(z_move)
+            elif cmd == b'G90':
+                absolute_coord = True
+            elif cmd == b'G91':
+                absolute_coord = False
+            elif cmd == b'M82':
+                absolute_extrude = True
+            elif cmd == b'M83':
+                absolute_extrude = False
+            elif cmd == b'G92':
+                for word in words[1:]:
+                    v = _parse_float(word)
+                    if v is None:
+                        continue
+                    if word[:1] == b'E':
+                        e = v
+                    elif word[:1] == b'Z':
+                        z = v
+    return {
+        'version': INDEX_VERSION, 'size': size, 'mtime': mtime,
+        'line_count': line_no, 'layers': layers,
+        'object_starts': object_starts, 'object_ends': object_ends,
+    }
+
+def write_index(gcode_path):
+    data = build_index(gcode_path)
+    fname = index_filename(gcode_path)
+    temp_fname = fname + ".tmp"
+    with open(temp_fname, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(temp_fname, fname)
+    return data
+
+# Build the index in a low priority background process so that a large
+# file does not compete with the reactor for the interpreter lock.
+class IndexBuilder:
+    def __init__(self, reactor, gcode_path, callback):
+        self.reactor = reactor
+        self.gcode_path = gcode_path
+        self.callback = callback
+        self.parent_conn, child_conn = multiprocessing.Pipe()
+        def wrapper():
+            queuelogger.clear_bg_logging()
+            try:
+                os.nice(10)
+                write_index(gcode_path)
+            except:
+                child_conn.send((True, traceback.format_exc()))
+                child_conn.close()
+                return
+            child_conn.send((False, None))
+            child_conn.close()
+        self.proc = multiprocessing.Process(target=wrapper)
+        self.proc.daemon = True
+        self.proc.start()
+        self.timer = reactor.register_timer(self._check_done,
+                                            reactor.monotonic() + 1.)
+    def _check_done(self, eventtime):
+        if self.proc.is_alive():
+            return eventtime + 1.
+        self.reactor.unregister_timer(self.timer)
+        is_err, res = True, "index process exited"
+        if self.parent_conn.poll():
+            is_err, res = self.parent_conn.recv()
+        self.proc.join()
+        self.parent_conn.close()
+        if is_err:
+            logging.info("Unable to index %s: %s", self.gcode_path, res)
+            self.callback(self.gcode_path, None)
+        else:
+            self.callback(self.gcode_path, load_index(self.gcode_path))
+        return self.reactor.NEVER
+
+
+######################################################################
+# Index lookups
+######################################################################
+
+class GCodeIndex:
+    def __init__(self, data):
+        self.layers = data['layers']
+        self.object_starts = data['object_starts']
+        self.start_offsets = [o[0] for o in self.object_starts]
+        self.object_ends = data['object_ends']
+        self.line_count = data['line_count']
+    def get_layer_count(self):
+        return len(self.layers)
+    def get_layer(self, layer):
+        # Returns (offset, z, line, e_position, filament_used)
+        if layer < 0 or layer >= len(self.layers):
+            return None
+        return tuple(self.layers[layer])
+    def find_object_start(self, file_position):
+        # Prefer the last object start shortly after the position, then
+        # the closest one before it
+        offsets = self.start_offsets
+        i = bisect.bisect_right(offsets, file_position + OBJECT_SEARCH_WINDOW)
+        if i and offsets[i-1] > file_position:
+            return offsets[i-1]
+        i = bisect.bisect_right(offsets, file_position)
+        if i:
+            return offsets[i-1]
+        return None
+
+def load_index(gcode_path):
+    fname = index_filename(gcode_path)
+    try:
+        with open(fname, 'r') as f:
+            data = json.load(f)
+        if (data.get('version') != INDEX_VERSION
+            or (data['size'], data['mtime']) != _file_signature(gcode_path)):
+            return None
+        return GCodeIndex(data)
+    except (OSError, ValueError, KeyError):
+        return None
@@ -3,9 +3,10 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, chelper
+import logging
 import subprocess #flsun add, for AI detect,Add a child thread
 import copy
+from . import size_compensation
 
 class GCodeMove:
     def __init__(self, config):
@@ -40,12 +41,13 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_fast_command('G0', self.fast_G1)
+        gcode.register_fast_command('G1', self.fast_G1)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True,
                                desc=self.cmd_GET_POSITION_help)
         gcode.register_command('SIZE_ANALYZE', self.cmd_SIZE_ANALYZE,
                                     desc=self.cmd_SIZE_ANALYZE_help)
-        self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.Coord = gcode.Coord
         # G-Code coordinate manipulation
         self.absolute_coord = self.absolute_extrude = True
@@ -60,6 +62,7 @@ class GCodeMove:
         self.last_AI_z = 0 #flsun add,
         self.max_z = 330 #flsun add
         self.reactor = self.printer.get_reactor() #flsun add 
+        self.time_lapse = printer.load_object(config, 'time_lapse')
         # G-Code state
         self.saved_states = {}
         self.move_transform = self.move_with_transform = None
@@ -81,6 +84,12 @@ class GCodeMove:
             self.y_offset[i] = max(min(self.y_offset[i], self.max_offset), -self.max_offset)
             self.x_size[i] = 70.0 - 70.0*self.x_offset[i]
             self.y_size[i] = 70.0 - 70.0*self.y_offset[i]
+        if self.size_flag:
+            self.size_compensation = size_compensation.SizeCompensation(
+                self.x_size, self.y_size, self.max_offset)
+        else:
+            self.size_compensation = size_compensation.FixedSizeCompensation(
+                self.x_size_offset, self.y_size_offset)
 
     cmd_SIZE_ANALYZE_help = "size calibration"
     def cmd_SIZE_ANALYZE(self, gcmd):
@@ -213,86 +222,109 @@ class GCodeMove:
         # Move
         params = gcmd.get_command_parameters()
         try:
-            for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'Z' in params: #flsun add ,to save z value while printing for power loss
-                if self.last_position[2] >= self.z_pos + 0.09:
-                    eventtime = self.reactor.monotonic()
-                    idle_timeout = self.printer.lookup_object("idle_timeout")
-                    is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"
-                    is_paused = self.printer.lookup_object("pause_resume").is_paused #wzy add
-                    if is_printing and not is_paused: #wzy modify
-                        gcode = self.printer.lookup_object('gcode')
-                        gcode.run_script_from_command("F103")
-                self.z_pos = self.last_position[2]
-
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
+            if 'F' in params and float(params['F']) <= 0.:
+                raise gcmd.error("Invalid speed in '%s'"
+                                 % (gcmd.get_commandline(),))
+            self._update_move_params(params)
+        except ValueError as e:
+            raise gcmd.error("Unable to parse move '%s'"
+                             % (gcmd.get_commandline(),))
+        self._queue_move()
+    def fast_G1(self, params):
+        # Plain G0/G1 lines with float parameters (see gcode.py)
+        if params.get('F', 1.) <= 0.:
+            return False
+        self._update_move_params(params)
+        self._queue_move()
+    def _update_move_params(self, params):
+        for pos, axis in enumerate('XYZ'):
+            if axis in params:
+                v = float(params[axis])
+                if not self.absolute_coord:
                     # value relative to position of last move
-                    self.last_position[3] += v
+                    self.last_position[pos] += v
                 else:
                     # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            
-            if self.last_position[3] < 10.0: #flsun add,set self.e_pos = 0 when a print start
+                    self.last_position[pos] = v + self.base_position[pos]
+        if 'Z' in params:
+            self._record_z()
+        if 'E' in params:
+            v = float(params['E']) * self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        if 'F' in params:
+            self.speed = float(params['F']) * self.speed_factor
+            self.pre_speed = -1.0
+        self._update_pace_speed('E' in params)
+    def _update_pace_speed(self, is_extrude):
+        # flsun add, limit travel moves to the pace speed in workmode 3
+        if not is_extrude and (self.printer_workmode.get_workmode() == 3):
+            if self.speed > self.printer_workmode.pace_speed:
+                self.pre_speed = self.speed
+                self.speed = self.printer_workmode.pace_speed
+        elif self.pre_speed > 0:
+            self.speed = self.pre_speed
+            self.pre_speed = -1.0
+    def _record_z(self):
+        # Runs after X/Y/Z are updated and before E, so the F103 record
+        # of a line does not include its own extrusion
+        #flsun add ,to save z value while printing for power loss
+        if self.last_position[2] >= self.z_pos + 0.09:
+            eventtime = self.reactor.monotonic()
+            idle_timeout = self.printer.lookup_object("idle_timeout")
+            is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"
+            is_paused = self.printer.lookup_object("pause_resume").is_paused #wzy add
+            if is_printing and not is_paused: #wzy modify
+                gcode = self.printer.lookup_object('gcode')
+                gcode.run_script_from_command("F103")
+        self.z_pos = self.last_position[2]
+    def _queue_move(self):
+        if self.last_position[3] < 10.0: #flsun add,set self.e_pos = 0 when a print start
+            self.e_pos = self.last_position[3]
+        if self.last_position[3] - self.e_pos > 70 and self.last_position[3] > 100 and self.last_position[2] - self.last_AI_z >= 0.10: #flsun add ,Perform AI detection when these conditions are met  
+            eventtime = self.reactor.monotonic()
+            idle_timeout = self.printer.lookup_object("idle_timeout")
+            is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"          
+            if is_printing: 
+                if self.last_AI_z >= 0.20 and self.first_layer_detect:
+                    gcode = self.printer.lookup_object('gcode')
+                    gcode.run_script_from_command("RESTORE_E_CURRENT")
+                    self.first_layer_detect = False
                 self.e_pos = self.last_position[3]
-            if self.last_position[3] - self.e_pos > 70 and self.last_position[3] > 100 and self.last_position[2] - self.last_AI_z >= 0.10: #flsun add ,Perform AI detection when these conditions are met  
-                eventtime = self.reactor.monotonic()
-                idle_timeout = self.printer.lookup_object("idle_timeout")
-                is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"          
-                if is_printing: 
-                    if self.last_AI_z >= 0.20 and self.first_layer_detect:
-                        gcode = self.printer.lookup_object('gcode')
-                        gcode.run_script_from_command("RESTORE_E_CURRENT")
-                        self.first_layer_detect = False
-                    self.e_pos = self.last_position[3]
-                    self.last_AI_z = self.last_position[2]
-                    subprocess.Popen(["bash", "/home/pi/flsun_func/time_lapse/time_lapse.sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) #flsun add
-            #flsun add, modify x and y direction,
+                self.last_AI_z = self.last_position[2]
+                self.time_lapse.request_frame()
+        #flsun add, modify x and y direction,
+        if self.last_position[2] > (self.max_z - 2.5):
             self.cali_position = self.last_position[:] #flsun add
-            real_x_size_offset = real_y_size_offset = 0
-            if self.last_position[2] > (self.max_z - 2.5):
-                real_x_size_offset = 0
-                real_y_size_offset = 0
-            else:
-                if self.size_flag:
-                    self.ffi_lib.get_size_offset(self.x_size, self.y_size, self.max_offset, self.last_position[0], self.last_position[1])
-                    real_x_size_offset = self.ffi_lib.get_x_size_offset()
-                    real_y_size_offset = self.ffi_lib.get_y_size_offset()
-                else:
-                    real_x_size_offset = self.x_size_offset
-                    real_y_size_offset = self.y_size_offset
-            self.cali_position[0] = self.last_position[0] * (1 + real_x_size_offset) 
-            self.cali_position[1] = self.last_position[1] * (1 + real_y_size_offset) 
-            
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
-                self.pre_speed = -1.0
-
-            if 'E' not in params and (self.printer_workmode.get_workmode() == 3):
-                if self.speed > self.printer_workmode.pace_speed:
-                    self.pre_speed = self.speed
-                    self.speed = self.printer_workmode.pace_speed
-            elif self.pre_speed > 0:
-                self.speed = self.pre_speed
-                self.pre_speed = -1.0
-                
-        except ValueError as e:
-            raise gcmd.error("Unable to parse move '%s'"
-                             % (gcmd.get_commandline(),))
+        else:
+            self.cali_position = self.size_compensation.calc_position(
+                self.last_position)
         self.move_with_transform(self.cali_position, self.speed) #flsun modfiy
+    def move_segments(self, coords, e_values=None, gcode_speed=None):
+        # Queue absolute X/Y/Z segments (and optional E parameters) as
+        # G1 moves would, without building a G-Code command per segment
+        if gcode_speed is not None:
+            self.speed = gcode_speed * self.speed_factor
+            self.pre_speed = -1.0
+        self._update_pace_speed(e_values is not None)
+        last_position = self.last_position
+        base_position = self.base_position
+        for i, coord in enumerate(coords):
+            last_position[0] = coord[0] + base_position[0]
+            last_position[1] = coord[1] + base_position[1]
+            last_position[2] = coord[2] + base_position[2]
+            self._record_z()
+            if e_values is not None:
+                v = e_values[i] * self.extrude_factor
+                if not self.absolute_extrude:
+                    last_position[3] += v
+                else:
+                    last_position[3] = v + base_position[3]
+            self._queue_move()
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
         # Set units to inches
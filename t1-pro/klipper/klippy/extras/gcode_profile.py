@@ -0,0 +1,120 @@
+# Per command timing of G-Code handlers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections
+
+# Number of recent durations kept per command for the percentiles
+SAMPLE_COUNT = 512
+# Minimum time between recalculations of the status summary
+STATUS_INTERVAL = 1.
+
+class CommandProfile:
+    def __init__(self):
+        self.count = 0
+        self.total_time = self.max_time = 0.
+        self.samples = collections.deque(maxlen=SAMPLE_COUNT)
+    def note(self, duration):
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.samples.append(duration)
+    def get_summary(self):
+        samples = sorted(self.samples)
+        num = len(samples)
+        return {
+            'count': self.count, 'total': self.total_time,
+            'avg': self.total_time / self.count,
+            'p50': samples[num // 2],
+            'p99': samples[min(int(num * .99), num - 1)],
+            'max': self.max_time,
+        }
+
+# Records the wall time of every dispatched command (macros include
+# the commands they run) and the time spent waiting on the gcode mutex
+class GCodeProfiler:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.monotonic = self.reactor.monotonic
+        self.gcode = self.printer.lookup_object('gcode')
+        self.mutex = self.gcode.get_mutex()
+        self.is_enabled = False
+        self.profiles = {}
+        self.mutex_start = (0, 0.)
+        self.status = {}
+        self.status_time = -STATUS_INTERVAL
+        self.gcode.register_command("GCODE_PROFILE", self.cmd_GCODE_PROFILE,
+                                    desc=self.cmd_GCODE_PROFILE_help)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("gcode/profile", self._handle_profile)
+        if config.getboolean('enabled', False):
+            self.set_enabled(True)
+    def set_enabled(self, enable):
+        if enable == self.is_enabled:
+            return
+        self.is_enabled = enable
+        if enable:
+            self.reset()
+            self.gcode.set_profiler(self)
+        else:
+            self.gcode.set_profiler(None)
+    def reset(self):
+        self.profiles.clear()
+        self.mutex_start = (self.mutex.wait_count, self.mutex.wait_time)
+        self.mutex.max_wait_time = 0.
+        self.status_time = -STATUS_INTERVAL
+    def note_command(self, cmd, start_time):
+        duration = self.monotonic() - start_time
+        profile = self.profiles.get(cmd)
+        if profile is None:
+            self.profiles[cmd] = profile = CommandProfile()
+        profile.note(duration)
+    def _get_mutex_wait(self):
+        start_count, start_time = self.mutex_start
+        return {'count': self.mutex.wait_count - start_count,
+                'total': self.mutex.wait_time - start_time,
+                'max': self.mutex.max_wait_time}
+    def _summarize(self):
+        return {
+            'enabled': self.is_enabled,
+            'mutex_wait': self._get_mutex_wait(),
+            'commands': {cmd: p.get_summary()
+                         for cmd, p in self.profiles.items()},
+        }
+    def get_status(self, eventtime):
+        if eventtime >= self.status_time + STATUS_INTERVAL:
+            self.status = self._summarize()
+            self.status_time = eventtime
+        return self.status
+    def _handle_profile(self, web_request):
+        if web_request.get('enable', None) is not None:
+            self.set_enabled(not not web_request.get('enable'))
+        if web_request.get('reset', False):
+            self.reset()
+        web_request.send(self._summarize())
+    cmd_GCODE_PROFILE_help = "Report or control G-Code command timing"
+    def cmd_GCODE_PROFILE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if enable is not None:
+            self.set_enabled(not not enable)
+        if gcmd.get_int('RESET', 0, minval=0, maxval=1):
+            self.reset()
+        count = gcmd.get_int('COUNT', 10, minval=1)
+        summary = self._summarize()
+        msg = ["G-Code profile (%s)" % (
+            ["disabled", "enabled"][self.is_enabled],)]
+        wait = summary['mutex_wait']
+        msg.append("mutex wait: count=%d total=%.3fs max=%.3fs" % (
+            wait['count'], wait['total'], wait['max']))
+        cmds = sorted(summary['commands'].items(),
+                      key=(lambda i: i[1]['total']), reverse=True)
+        for cmd, s in cmds[:count]:
+            msg.append("%s: count=%d total=%.3fs avg=%.4fs p50=%.4fs"
+                       " p99=%.4fs max=%.4fs" % (
+                           cmd, s['count'], s['total'], s['avg'], s['p50'],
+                           s['p99'], s['max']))
+        gcmd.respond_info("\n".join(msg))
+
+def load_config(config):
+    return GCodeProfiler(config)
@@ -11,9 +11,14 @@
 #
 # 修订记录：
 
-from collections import deque
+import array
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class RollbackCheckZChange():
     def __init__(self):
@@ -23,24 +28,22 @@ class RollbackCheckZChange():
         self.printing_height = 0.0
         self.nLoop = 0
 
-    def is_break(self, item, triggerPrintLen):
+    # start_z/start_e/end_z/end_e为该行gcode执行前后的gcode坐标
+    def is_break(self, start_z, start_e, end_z, end_e, triggerPrintLen):
         self.nLoop += 1
-        # 读取gcode文件的时间
-        start_pos = item['gcode_move_before']['gcode_position']
-        end_pos = item['gcode_move_after']['gcode_position']
         # 判断是否有Z移动
         threshold = .000000001
-        delta_Z = end_pos.z - start_pos.z
+        delta_Z = end_z - start_z
         move_d = abs(delta_Z)
         # 判断是否有挤出
-        delta_E = end_pos.e - start_pos.e
-        move_e = abs(end_pos.e - start_pos.e)
+        delta_E = end_e - start_e
+        move_e = abs(end_e - start_e)
         # 没有Z变化
         if move_d < threshold:
             # 挤出机正向变化,锁定Z高度
             if (delta_E > threshold) and (not self.lock):
                 self.lock = True
-                self.printing_height = end_pos.z
+                self.printing_height = end_z
             # Z没有变化,继续回滚
             return False
         # 有Z变化
@@ -50,19 +53,19 @@ class RollbackCheckZChange():
                 # 是否锁定
                 if self.lock:
                     # 目标位置低于打印高度,避免撞模型,退出
-                    if end_pos.z < self.printing_height:
-                        logging.info(f"[RollbackCheckZChange] avoid collision with other objects : {start_pos} -> {end_pos}, trigger print:{triggerPrintLen}")
+                    if end_z < self.printing_height:
+                        logging.info(f"[RollbackCheckZChange] avoid collision with other objects : Z{start_z} E{start_e} -> Z{end_z} E{end_e}, trigger print:{triggerPrintLen}")
                         return True
             else:
                 # 存在换层,避免碰撞模型,退出
-                if start_pos.z < self.printing_height:
-                    logging.info(f"[RollbackCheckZChange] change level Z: {self.printing_height} -> {start_pos.z} avoid collision with other objects, trigger print:{triggerPrintLen}")
+                if start_z < self.printing_height:
+                    logging.info(f"[RollbackCheckZChange] change level Z: {self.printing_height} -> {start_z} avoid collision with other objects, trigger print:{triggerPrintLen}")
                     return True
 
             # 有抬升或者下降在范围内,判断是否有挤出
             if move_e > threshold:
                 # Gcode的Z和E不应该同时动
-                logging.info(f"[RollbackCheckZChange] abnormal move : {start_pos} -> {end_pos}, trigger print:{triggerPrintLen}")
+                logging.info(f"[RollbackCheckZChange] abnormal move : Z{start_z} E{start_e} -> Z{end_z} E{end_e}, trigger print:{triggerPrintLen}")
                 return True
             else:
                 return False
@@ -74,6 +77,99 @@ class RollbackCheckZChange():
             f"printing_height:{self.printing_height}"
         )
 
+# gcode_move中很少变化的状态（坐标基准、模式、倍率），仅在变化时保存一份
+class GcodeMoveState():
+    def __init__(self, gcode_move):
+        self.absolute_coord = gcode_move.absolute_coord
+        self.absolute_extrude = gcode_move.absolute_extrude
+        self.base_position = list(gcode_move.base_position)
+        self.homing_position = list(gcode_move.homing_position)
+        self.speed_factor = gcode_move.speed_factor
+        self.extrude_factor = gcode_move.extrude_factor
+
+    def matches(self, gcode_move):
+        return (self.base_position == gcode_move.base_position
+                and self.extrude_factor == gcode_move.extrude_factor
+                and self.absolute_coord == gcode_move.absolute_coord
+                and self.absolute_extrude == gcode_move.absolute_extrude
+                and self.homing_position == gcode_move.homing_position
+                and self.speed_factor == gcode_move.speed_factor)
+
+
+# 预分配的环形缓存（按字段分别存储的数组），每行gcode只写入数组元素，不创建对象
+class RollbackRing():
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.head = 0
+        self.offset = array.array('q', [0]) * size
+        self.speed = array.array('d', [0.]) * size
+        self.before = [array.array('d', [0.]) * size for i in range(4)]
+        self.after = [array.array('d', [0.]) * size for i in range(4)]
+        self.state_before = array.array('q', [0]) * size
+        self.state_after = array.array('q', [0]) * size
+        self.pending_offset = self.pending_state = 0
+        self.pending_speed = 0.
+        self.pending_before = (0., 0., 0., 0.)
+
+    def __len__(self):
+        return self.count
+
+    # 暂存当前行的执行前信息，end()时才写入槽位并计入缓存
+    def begin(self, offset, position, speed, state_id):
+        self.pending_offset = offset
+        self.pending_speed = speed
+        self.pending_before = (position[0], position[1], position[2],
+                               position[3])
+        self.pending_state = state_id
+
+    def end(self, position, state_id):
+        if not self.size:
+            return
+        i = self.head
+        self.offset[i] = self.pending_offset
+        self.speed[i] = self.pending_speed
+        before = self.before
+        pending_before = self.pending_before
+        before[0][i] = pending_before[0]
+        before[1][i] = pending_before[1]
+        before[2][i] = pending_before[2]
+        before[3][i] = pending_before[3]
+        self.state_before[i] = self.pending_state
+        after = self.after
+        after[0][i] = position[0]
+        after[1][i] = position[1]
+        after[2][i] = position[2]
+        after[3][i] = position[3]
+        self.state_after[i] = state_id
+        self.head = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    # 从最新到最旧的槽位索引
+    def newest_first(self):
+        size = self.size
+        head = self.head
+        return [(head - n) % size for n in range(1, self.count + 1)]
+
+    # 缓存为空时返回暂存行的快照，未启用缓存时返回None
+    def oldest_state_id(self):
+        if not self.count:
+            if not self.size:
+                return None
+            return self.pending_state
+        return self.state_before[(self.head - self.count) % self.size]
+
+    def resize(self, new_size):
+        new_ring = RollbackRing(new_size)
+        order = self.newest_first()[:new_size]
+        order.reverse()
+        for i in order:
+            new_ring.begin(self.offset[i], [b[i] for b in self.before],
+                           self.speed[i], self.state_before[i])
+            new_ring.end([a[i] for a in self.after], self.state_after[i])
+        return new_ring
+
 
 class LocatePrintingGcode():
     def __init__(self, config):
@@ -90,8 +186,11 @@ class LocatePrintingGcode():
         self.gravity_target = config.getfloat('gravity_target', 0.0, minval=0.)
         # 抵消不缺料情况下,因暂停时重力流失的料,设置补偿最小值,优先级高于目标值
         self.gravity_min = config.getfloat('gravity_min', 0.0, minval=0.)
-        self.queue = deque(maxlen=self.max_size)
-        self.parseinfo = dict()
+        self.queue = RollbackRing(self.max_size)
+        # gcode_move状态快照：state_id -> GcodeMoveState
+        self.move_states = {}
+        self.state_id = 0
+        self.move_state = None
         self.saved_states = {}
         # 是否已经回退了
         self.is_roolback = False
@@ -106,30 +205,12 @@ class LocatePrintingGcode():
         try:
             if 'S' in params:
                 new_max_size = gcmd.get_int('S')
-                cur_size = len(self.queue)
-                if new_max_size == self.max_size:
-                    pass
-                elif new_max_size < cur_size:
-                    if new_max_size < 0:
-                        raise gcmd.error(
-                            f"Invalid queue size in '{gcmd.get_commandline()}'")
-                    # 创建一个新的 deque，设置新的最大长度
-                    new_queue = deque(maxlen=new_max_size)
-                    # 从旧 deque 的末尾开始，将最近的元素复制到新的 deque 中
-                    new_queue.extend(list(self.queue)[-new_max_size:])
-                    # 替换旧的 deque
-                    self.queue = new_queue
-                    # 更新 max_size 属性
-                    self.max_size = new_max_size
-                    logging.info(f"[LocatePrintingGcode]shrink_queue_capacity: new capacity {new_max_size}")
-                else:
-                    # 创建一个新的 deque，设置新的最大长度
-                    new_queue = deque(maxlen=new_max_size)
-                    # 将旧 deque 中的内容复制到新的 deque 中
-                    new_queue.extend(self.queue)
-                    # 替换旧的 deque
-                    self.queue = new_queue
-                    # 更新 max_size 属性
+                if new_max_size < 0:
+                    raise gcmd.error(
+                        f"Invalid queue size in '{gcmd.get_commandline()}'")
+                if new_max_size != self.max_size:
+                    # 保留最近的记录，修改缓存容量
+                    self.queue = self.queue.resize(new_max_size)
                     self.max_size = new_max_size
                     logging.info(f"[LocatePrintingGcode]change queue max_size: {new_max_size}")
 
@@ -174,22 +255,52 @@ class LocatePrintingGcode():
             raise self.gcode.error(f"not found {module_name} module_name)")
         return module
 
+    # 检查gcode_move的基准状态是否变化，变化时保存新的快照
+    def _check_move_state(self):
+        if self.move_state is None or not self.move_state.matches(self.gcode_move):
+            self.state_id += 1
+            self.move_state = GcodeMoveState(self.gcode_move)
+            self.move_states[self.state_id] = self.move_state
+            # 删除缓存中已不再引用的快照
+            oldest = self.queue.oldest_state_id()
+            if oldest is None:
+                # 未启用缓存（F109 S0）时只保留当前快照
+                oldest = self.state_id
+            for state_id in [i for i in self.move_states if i < oldest]:
+                del self.move_states[state_id]
+        return self.state_id
+
     # 记录每行gcode对应的位置信息
     def record_gcode_begin(self, line, file_position):
-        self.parseinfo = {}
-        self.parseinfo['gcmd'] = line
-        self.parseinfo['time'] = self.reactor.monotonic()
-        self.parseinfo['offset'] = file_position
-        self.parseinfo['gcode_move_before'] = self.gcode_move.get_status()
-        self.parseinfo['gcode_state'] = self.gcode_move.get_gcode_state()
+        gcode_move = self.gcode_move
+        self.queue.begin(file_position, gcode_move.last_position,
+                         gcode_move.speed, self._check_move_state())
 
     # 记录挤出机位置信息
     def record_gcode_end(self):
-        if not self.parseinfo:
-            return
-        self.parseinfo['gcode_move_after'] = self.gcode_move.get_status()
-        self.queue.append(self.parseinfo)
-        self.parseinfo = {}
+        self.queue.end(self.gcode_move.last_position,
+                       self._check_move_state())
+
+    # gcode坐标(z, e)，与gcode_move.get_status()的gcode_position一致
+    def _gcode_position_ze(self, position, state_id, i):
+        state = self.move_states[state_id]
+        base = state.base_position
+        return (position[2][i] - base[2],
+                (position[3][i] - base[3]) / state.extrude_factor)
+
+    # 回退时才重建完整的gcode_state
+    def _build_gcode_state(self, i):
+        queue = self.queue
+        state = self.move_states[queue.state_before[i]]
+        return {
+            'absolute_coord': state.absolute_coord,
+            'absolute_extrude': state.absolute_extrude,
+            'base_position': list(state.base_position),
+            'last_position': [b[i] for b in queue.before],
+            'homing_position': list(state.homing_position),
+            'speed': queue.speed[i], 'speed_factor': state.speed_factor,
+            'extrude_factor': state.extrude_factor,
+        }
 
     # 不缺料的情况下,判断是否继续补偿, e_offset为当前gcode补偿的料长
     def check_rollback(self, e_offset):
@@ -213,30 +324,10 @@ class LocatePrintingGcode():
                 return 0
         return -1
 
-    # 恢复到断料时的位置，尽量恢复，会进行一系列安全判断
-    def set_resume_pos(self, runout_info):
-        logging.info(f"[LocatePrintingGcode]set_resume_pos:runout_info{runout_info}")
-        et = runout_info.get('eventtime')
-        motion_report = runout_info.get('motion_report')
-        if (et is None or motion_report is None):
-            return
-
-        live_pos = motion_report['live_position']
-        if live_pos is None:
-            return
-
-        # 检查队列是否为空
-        if not self.queue:
-            logging.info("[LocatePrintingGcode] Queue is empty")
-            return
-
-        # 根据挤出机流量定位gcode
-        extrude_locate = {}
-        # 获取挤出机位置
-        posE = live_pos[3]
-        # 挤出机缺料的位置
-        posELack = posE + self.e_offset
-
+    # 逐行回看缓存，查找恢复打印的行，返回(回看行数, 槽位索引)
+    def _search_resume_loop(self, posE, posELack):
+        # 根据挤出机流量定位gcode，记录缓存槽位索引
+        extrude_locate = None
         checkZ = RollbackCheckZChange()
 
         # 是否已经回退了
@@ -245,17 +336,24 @@ class LocatePrintingGcode():
         nLoop = 0
         # 循环是否继续
         loop_continue = True
-        for item in reversed(self.queue):
+        queue = self.queue
+        start_e_list = queue.before[3]
+        end_e_list = queue.after[3]
+        for item in queue.newest_first():
             nLoop += 1
-            # 读取gcode文件的时间
-            start_pos = item['gcode_move_before']['position']
-            end_pos = item['gcode_move_after']['position']
-            remainLen = posELack - end_pos[3]
-            deltaE = end_pos[3] - start_pos[3]
-            triggerPrintLen = end_pos[3] - posE
+            start_e = start_e_list[item]
+            end_e = end_e_list[item]
+            remainLen = posELack - end_e
+            deltaE = end_e - start_e
+            triggerPrintLen = end_e - posE
 
             # 如果检测到Z变动，则循环就可以退出
-            if checkZ.is_break(item, triggerPrintLen):
+            start_gz, start_ge = self._gcode_position_ze(
+                queue.before, queue.state_before[item], item)
+            end_gz, end_ge = self._gcode_position_ze(
+                queue.after, queue.state_after[item], item)
+            if checkZ.is_break(start_gz, start_ge, end_gz, end_ge,
+                               triggerPrintLen):
                 loop_continue = False
 
             # 行尾不缺料
@@ -287,9 +385,9 @@ class LocatePrintingGcode():
             else:
                 # 行尾缺料
                 # 行开始时缺料
-                if posELack < start_pos[3]:
+                if posELack < start_e:
                     # 行结束位置已经超过事件起始位置,该行gcode是正常打印,不能再回滚了!
-                    if end_pos[3] < posE:
+                    if end_e < posE:
                         # 该行未发生任何异常，从此行退出，不再回看
                         logging.info(f"roolback {nLoop} lines, something unexpected happened !! trigger print:{triggerPrintLen}, loss {remainLen}")
                         break
@@ -299,7 +397,7 @@ class LocatePrintingGcode():
                     lastLinePrint = 0
                     if deltaE > 0 and remainLen < 0:
                         lastLinePrint = 100 * \
-                            (posELack - start_pos[3]) / deltaE
+                            (posELack - start_e) / deltaE
                     extrude_locate = item
                     logging.info(f"roolback {nLoop} lines locate loss {remainLen} filament gcode, progress {lastLinePrint}, trigger print:{triggerPrintLen}")
                     break
@@ -307,13 +405,117 @@ class LocatePrintingGcode():
             if deltaE > 0:
                 self.is_roolback = True
                 extrude_locate = item
+        return nLoop, extrude_locate
+
+    # 与_search_resume_loop结果一致，用numpy一次计算所有行的判断条件
+    def _search_resume_numpy(self, posE, posELack):
+        np = numpy
+        queue = self.queue
+        n = len(queue)
+        order = (queue.head - 1 - np.arange(n)) % queue.size
+        def column(arr):
+            return np.frombuffer(arr, dtype=np.float64)[order]
+        start_e = column(queue.before[3])
+        end_e = column(queue.after[3])
+        deltaE = end_e - start_e
+        # gcode坐标下的Z和E，对应RollbackCheckZChange的判断
+        ids = np.array(sorted(self.move_states), dtype=np.int64)
+        states = [self.move_states[i] for i in ids]
+        base_z = np.array([st.base_position[2] for st in states])
+        base_e = np.array([st.base_position[3] for st in states])
+        factor = np.array([st.extrude_factor for st in states])
+        sb = np.searchsorted(
+            ids, np.frombuffer(queue.state_before, dtype=np.int64)[order])
+        sa = np.searchsorted(
+            ids, np.frombuffer(queue.state_after, dtype=np.int64)[order])
+        start_gz = column(queue.before[2]) - base_z[sb]
+        end_gz = column(queue.after[2]) - base_z[sa]
+        delta_gz = end_gz - start_gz
+        delta_ge = ((end_e - base_e[sa]) / factor[sa]
+                    - (start_e - base_e[sb]) / factor[sb])
+        threshold = .000000001
+        index = np.arange(n)
+        no_z_move = np.abs(delta_gz) < threshold
+        # 第一次无Z移动且正向挤出时锁定打印高度
+        lock_at = np.flatnonzero(no_z_move & (delta_ge > threshold))
+        lock_at = lock_at[0] if len(lock_at) else n
+        locked = index > lock_at
+        height = np.where(locked, end_gz[lock_at] if lock_at < n else 0., 0.)
+        z_break = ~no_z_move & (
+            ((delta_gz < 0) & locked & (end_gz < height))
+            | ((delta_gz > 0) & (start_gz < height))
+            | (np.abs(delta_ge) > threshold))
+        z_stop = np.maximum.accumulate(z_break)
+        # 行尾不缺料的行累加重力补偿值
+        no_lack = (posELack - end_e) > 0
+        compensate = np.cumsum(np.where(no_lack, deltaE, 0.))
+        under_target = compensate < self.gravity_target
+        check_exit = ~under_target & (compensate < self.gravity_min)
+        check_done = ~under_target & ~check_exit
+        # 处理该行之前是否已经回退过
+        positive = deltaE > 0
+        rolled_back = np.concatenate(([False], np.logical_or.accumulate(
+            positive)[:-1]))
+        gravity = self.gravity_min > 0.0
+        locate_self = (
+            (no_lack & ~z_stop & gravity & check_done & ~rolled_back)
+            | (~no_lack & (posELack >= start_e)))
+        stop = (locate_self
+                | (no_lack & (z_stop | (not gravity) | check_exit))
+                | (~no_lack & (posELack < start_e) & (end_e < posE)))
+        stops = np.flatnonzero(stop)
+        if len(stops):
+            last = stops[0]
+            nLoop = last + 1
+            if locate_self[last]:
+                self.is_roolback = bool(rolled_back[last] or no_lack[last])
+                logging.info(f"roolback {nLoop} lines locate, loss {posELack - end_e[last]}, filament {compensate[last]} mm, trigger print:{end_e[last] - posE}")
+                return int(nLoop), int(order[last])
+        else:
+            last = nLoop = n
+        # 否则回退到最后一次正向挤出的行
+        prior = np.flatnonzero(positive[:last])
+        self.is_roolback = len(prior) > 0
+        logging.info(f"roolback {nLoop} lines stop, filament {compensate[nLoop - 1]} mm, z stop:{bool(z_stop[nLoop - 1])}")
+        if not len(prior):
+            return int(nLoop), None
+        return int(nLoop), int(order[prior[-1]])
+
+    # 恢复到断料时的位置，尽量恢复，会进行一系列安全判断
+    def set_resume_pos(self, runout_info):
+        logging.info(f"[LocatePrintingGcode]set_resume_pos:runout_info{runout_info}")
+        et = runout_info.get('eventtime')
+        motion_report = runout_info.get('motion_report')
+        if (et is None or motion_report is None):
+            return
+
+        live_pos = motion_report['live_position']
+        if live_pos is None:
+            return
+
+        # 检查队列是否为空
+        if not self.queue:
+            logging.info("[LocatePrintingGcode] Queue is empty")
+            return
 
-        logging.info(f"set_resume_pos roolback {nLoop} lines, locate:{extrude_locate}")
+        # 获取挤出机位置
+        posE = live_pos[3]
+        # 挤出机缺料的位置
+        posELack = posE + self.e_offset
 
-        if len(extrude_locate) > 0:
-            self.virtual_sd.set_resume_file_position(extrude_locate['offset'])
-            self.gcode_move.set_SAVE_GCODE_STATE(
-                'PAUSE_STATE', extrude_locate['gcode_state'])
+        if numpy is not None:
+            nLoop, extrude_locate = self._search_resume_numpy(posE, posELack)
+        else:
+            nLoop, extrude_locate = self._search_resume_loop(posE, posELack)
+
+        if extrude_locate is None:
+            logging.info(f"set_resume_pos roolback {nLoop} lines, locate:{{}}")
+            return
+        offset = self.queue.offset[extrude_locate]
+        gcode_state = self._build_gcode_state(extrude_locate)
+        logging.info(f"set_resume_pos roolback {nLoop} lines, locate:offset={offset} gcode_state={gcode_state}")
+        self.virtual_sd.set_resume_file_position(offset)
+        self.gcode_move.set_SAVE_GCODE_STATE('PAUSE_STATE', gcode_state)
 
     def get_status(self, eventtime=None):
         return {
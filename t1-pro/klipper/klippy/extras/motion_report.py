@@ -58,8 +58,9 @@ class APIDumpHelper:
         template = web_request.get_dict('response_template', {})
         self.clients[cconn] = template
         self._start()
-    def add_internal_client(self):
-        cconn = InternalDumpClient()
+    def add_internal_client(self, cconn=None):
+        if cconn is None:
+            cconn = InternalDumpClient()
         self.clients[cconn] = {}
         self._start()
         return cconn
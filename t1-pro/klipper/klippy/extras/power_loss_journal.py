@@ -0,0 +1,134 @@
+# Append-only record ring used to checkpoint print state for power loss
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, zlib, logging
+
+JOURNAL_MAGIC = b'PLRJ'
+JOURNAL_VERSION = 1
+RECORD_SIZE = 128
+
+FLAG_ABSOLUTE_COORD = 1 << 0
+FLAG_ABSOLUTE_EXTRUDE = 1 << 1
+FLAG_CLEARED = 1 << 15
+
+# magic, version, flags, sequence, filename crc, file position,
+# print_duration, filament_used, x, y, z, e, fan_speed, nozzle_temp,
+# bed_temp
+RECORD_FORMAT = struct.Struct('<4sHHQIQddddddddd')
+CRC_FORMAT = struct.Struct('<I')
+RECORD_PAD = RECORD_SIZE - RECORD_FORMAT.size - CRC_FORMAT.size
+
+def filename_crc(filename):
+    if filename is None:
+        return 0
+    return zlib.crc32(str(filename).encode()) & 0xffffffff
+
+# Fixed size ring of CRC protected records.  Every checkpoint is a
+# single small pwrite() to a preallocated slot of a file opened with
+# O_DSYNC, so no file replace or filesystem wide sync is needed.  On
+# read back the newest record with a valid CRC wins, which means a torn
+# write (power lost mid-record) simply falls back to the previous one.
+class PowerLossJournal:
+    def __init__(self, filename, record_count):
+        self.filename = filename
+        self.record_count = record_count
+        self.sequence = 0
+        self.fd = None
+        self._open()
+        newest = self._scan()
+        if newest is not None:
+            self.sequence = newest['sequence']
+    def _open(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_DSYNC', os.O_SYNC)
+        self.fd = os.open(self.filename, flags, 0o644)
+        size = self.record_count * RECORD_SIZE
+        if os.fstat(self.fd).st_size < size:
+            # Allocate the blocks up front so that later record writes
+            # never need to update filesystem metadata
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, size)
+            os.fsync(self.fd)
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    def _pack(self, sequence, flags, state):
+        data = RECORD_FORMAT.pack(
+            JOURNAL_MAGIC, JOURNAL_VERSION, flags, sequence,
+            filename_crc(state.get('sd_filename')),
+            int(state.get('file_position', 0)),
+            float(state.get('print_duration', 0.)),
+            float(state.get('filament_used', 0.)),
+            float(state.get('x_pos', 0.)), float(state.get('y_pos', 0.)),
+            float(state.get('z_pos', 0.)), float(state.get('e_pos', 0.)),
+            float(state.get('fan_speed', 0.)),
+            float(state.get('nozzle_temp', 0.)),
+            float(state.get('bed_temp', 0.)))
+        data += CRC_FORMAT.pack(zlib.crc32(data) & 0xffffffff)
+        return data + b'\x00' * RECORD_PAD
+    def _unpack(self, data):
+        if len(data) < RECORD_SIZE:
+            return None
+        body = data[:RECORD_FORMAT.size]
+        crc = CRC_FORMAT.unpack_from(data, RECORD_FORMAT.size)[0]
+        if crc != zlib.crc32(body) & 0xffffffff:
+            return None
+        (magic, version, flags, sequence, file_crc, file_position,
+         print_duration, filament_used, x_pos, y_pos, z_pos, e_pos,
+         fan_speed, nozzle_temp, bed_temp) = RECORD_FORMAT.unpack(body)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            return None
+        return {
+            'sequence': sequence, 'cleared': bool(flags & FLAG_CLEARED),
+            'file_crc': file_crc, 'file_position': file_position,
+            'print_duration': print_duration, 'filament_used': filament_used,
+            'x_pos': x_pos, 'y_pos': y_pos, 'z_pos': z_pos, 'e_pos': e_pos,
+            'fan_speed': fan_speed, 'nozzle_temp': nozzle_temp,
+            'bed_temp': bed_temp,
+            'absolute_coordinates': bool(flags & FLAG_ABSOLUTE_COORD),
+            'absolute_extrude': bool(flags & FLAG_ABSOLUTE_EXTRUDE),
+        }
+    def _scan(self):
+        try:
+            data = os.pread(self.fd, self.record_count * RECORD_SIZE, 0)
+        except OSError:
+            logging.exception("power_loss_journal read")
+            return None
+        newest = None
+        for pos in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            record = self._unpack(data[pos:pos+RECORD_SIZE])
+            if record is None:
+                continue
+            if newest is None or record['sequence'] > newest['sequence']:
+                newest = record
+        return newest
+    def _write(self, flags, state):
+        self.sequence += 1
+        slot = self.sequence % self.record_count
+        data = self._pack(self.sequence, flags, state)
+        os.pwrite(self.fd, data, slot * RECORD_SIZE)
+    def append(self, state):
+        flags = 0
+        if state.get('absolute_coordinates', True):
+            flags |= FLAG_ABSOLUTE_COORD
+        if state.get('absolute_extrude', True):
+            flags |= FLAG_ABSOLUTE_EXTRUDE
+        self._write(flags, state)
+    def clear(self):
+        # A tombstone record hides any older checkpoints of a prior print
+        self._write(FLAG_CLEARED, {})
+    def read_newest(self, sd_filename=None):
+        record = self._scan()
+        if record is None or record['cleared']:
+            return None
+        if (sd_filename is not None
+            and record['file_crc'] != filename_crc(sd_filename)):
+            return None
+        return record
+    def get_sequence(self):
+        return self.sequence
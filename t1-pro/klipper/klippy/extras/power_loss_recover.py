@@ -10,11 +10,38 @@
 #
 # 修订记录：
 
-import logging
+import os, logging
+from . import power_loss_journal
+
+CHECKPOINT_POLL_TIME = 1.
 
 class PowerLossRecover:
     def __init__(self, config):
         self.printer = config.get_printer()
+        # Checkpoints are appended to a small binary journal instead of
+        # rewriting the whole save_variables file on every layer
+        journal_filename = os.path.expanduser(
+            config.get('journal_filename', '~/power_loss_journal.bin'))
+        journal_records = config.getint('journal_records', 64, minval=2)
+        try:
+            self.journal = power_loss_journal.PowerLossJournal(
+                journal_filename, journal_records)
+        except OSError as e:
+            raise config.error("Unable to open power loss journal %s: %s"
+                               % (journal_filename, e))
+        # Checkpoints are written whenever any enabled threshold (print
+        # time, extruded filament, file bytes) is crossed, in addition to
+        # the layer change checkpoints requested via F103
+        self.checkpoint_time = config.getfloat('checkpoint_time', 30.,
+                                               minval=0.)
+        self.checkpoint_extrude = config.getfloat('checkpoint_extrude', 0.,
+                                                  minval=0.)
+        self.checkpoint_bytes = config.getint('checkpoint_bytes', 0, minval=0)
+        self.checkpoint_min_interval = config.getfloat(
+            'checkpoint_min_interval', 2., minval=0.)
+        self._reset_checkpoint_state()
+        self.checkpoint_timer = None
+        self.is_recovering = False
 
         # Register commands
         self.gcode = self.printer.lookup_object('gcode')
@@ -35,7 +62,11 @@ class PowerLossRecover:
         self.gcode.register_command("F102", self.cmd_F102, desc=self.cmd_F102_help)
         self.gcode.register_command("F103", self.cmd_F103, desc=self.cmd_F103_help)
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
-        
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+        self.printer.register_event_handler("virtual_sdcard:reset_file",
+                                            self._handle_reset_file)
+
     def _lookup_required_module(self, module_name):
         module = self.printer.lookup_object(module_name, None)
         if module is None:
@@ -46,6 +77,36 @@ class PowerLossRecover:
         self.extruder = self.printer.lookup_object('extruder', None)
         if self.extruder is None:
             raise self.gcode.error("not found extruder module")
+        reactor = self.printer.get_reactor()
+        self.checkpoint_timer = reactor.register_timer(
+            self._checkpoint_event, reactor.NOW)
+
+    def _handle_disconnect(self):
+        self.journal.close()
+
+    def _handle_reset_file(self):
+        # A new print (or a cancel) invalidates older checkpoints
+        self._reset_checkpoint_state()
+        try:
+            self.journal.clear()
+        except OSError:
+            logging.exception("power loss journal clear")
+
+    # 读取断电续打信息：save_variables中的基础信息叠加日志中最新的有效记录
+    def _load_state(self):
+        variables = dict(self.save_variables.get_status(None)['variables'])
+        try:
+            record = self.journal.read_newest(variables.get('sd_filename'))
+        except OSError:
+            logging.exception("power loss journal read")
+            record = None
+        if record is not None:
+            for name in ('file_position', 'print_duration', 'filament_used',
+                         'x_pos', 'y_pos', 'z_pos', 'e_pos', 'fan_speed',
+                         'nozzle_temp', 'bed_temp', 'absolute_coordinates',
+                         'absolute_extrude'):
+                variables[name] = record[name]
+        return variables
 
     cmd_RESUME_INTERRUPTED_help = "Recover print after power loss and power on"
     def cmd_RESUME_INTERRUPTED(self, gcmd):
@@ -54,7 +115,7 @@ class PowerLossRecover:
         if print_stats['state'] == "printing" :
             self.gcode.respond_info("printing, can't resume interrupted")
             return
-        variables = self.save_variables.get_status(None)['variables']
+        variables = self._load_state()
         logging.info(f"RESUME_INTERRUPTED variables = {variables}")
         # read continue print parameters and recover print
         last_file = variables.get('sd_filename')
@@ -64,9 +125,16 @@ class PowerLossRecover:
 
     cmd_F102_help = "Recover pre-print prearation actions"
     def cmd_F102(self, gcmd):
+        self.is_recovering = True
+        try:
+            self._recover_print_state(gcmd)
+        finally:
+            self.is_recovering = False
+
+    def _recover_print_state(self, gcmd):
         reactor = self.printer.get_reactor()
 
-        variables = self.save_variables.get_status(reactor.monotonic())['variables']
+        variables = self._load_state()
         # read continue print parameters and recover print
         e_pos = float(variables.get('e_pos', 0.))
         x_pos = float(variables.get('x_pos', 0.))
@@ -177,42 +245,104 @@ class PowerLossRecover:
             self.gcode.run_script_from_command("G91")
         self.gcode.run_script_from_command("CLEAR_PAUSE")
 
+    # Collect the print state that a checkpoint record needs
+    def _capture_state(self, eventtime, after_current_line):
+        print_stats = self.print_stats.get_status(eventtime)
+        newvars = dict()
+        v_sd_stats = self.v_sd.get_status(eventtime)
+        newvars['sd_filename'] = str(v_sd_stats['file_path'])
+        newvars['file_position'] = v_sd_stats['file_position']
+        if after_current_line and self.v_sd.is_cmd_from_sd():
+            # The gcode_move state already includes the line being
+            # executed, so resume from the line after it
+            newvars['file_position'] = self.v_sd.get_file_position()
+
+        gcode_move = self.gcode_move.get_status(eventtime)
+        gcode_position = gcode_move['gcode_position']
+        newvars['e_pos'] = gcode_position.e
+        newvars['x_pos'] = gcode_position.x
+        newvars['y_pos'] = gcode_position.y
+        newvars['z_pos'] = gcode_position.z
+        newvars['absolute_extrude'] = gcode_move['absolute_extrude']
+        newvars['absolute_coordinates'] = gcode_move['absolute_coordinates']
+
+        newvars['print_duration'] = print_stats['print_duration']
+        newvars['filament_used'] = float(print_stats['filament_used'])
+        fan_status = self.fan.get_status(eventtime)
+        fan_max_power = max(0.1, float(fan_status['max_power']))
+        newvars['fan_speed'] = float(fan_status['speed']) / fan_max_power
+
+        newvars['nozzle_temp'] = float(self.extruder.get_status(eventtime)['target'])
+        newvars['bed_temp'] = float(self.heater_bed.get_status(eventtime)['target'])
+        # 零件跳过信息在变化时已由exclude_object保存到save_variables
+        return newvars
+
+    def _write_checkpoint(self, eventtime, after_current_line):
+        newvars = self._capture_state(eventtime, after_current_line)
+        self.journal.append(newvars)
+        self.checkpoint_pending = False
+        self.last_checkpoint_time = eventtime
+        self.last_checkpoint = newvars
+
+    # Checkpoint scheduler
+    def _reset_checkpoint_state(self):
+        self.checkpoint_pending = False
+        self.last_checkpoint_time = 0.
+        self.last_checkpoint = {'print_duration': 0., 'filament_used': 0.,
+                                'file_position': 0}
+
+    def _checkpoint_due(self, eventtime, print_stats):
+        if not self.last_checkpoint_time:
+            # First pass of a (resumed) print - use it as the baseline
+            self.last_checkpoint_time = eventtime
+            self.last_checkpoint = {
+                'print_duration': print_stats['print_duration'],
+                'filament_used': print_stats['filament_used'],
+                'file_position': self.v_sd.file_position}
+            return False
+        if eventtime - self.last_checkpoint_time < self.checkpoint_min_interval:
+            return False
+        if self.checkpoint_pending:
+            return True
+        last = self.last_checkpoint
+        if (self.checkpoint_time and print_stats['print_duration']
+                - last['print_duration'] >= self.checkpoint_time):
+            return True
+        if (self.checkpoint_extrude and print_stats['filament_used']
+                - last['filament_used'] >= self.checkpoint_extrude):
+            return True
+        if (self.checkpoint_bytes and self.v_sd.file_position
+                - last['file_position'] >= self.checkpoint_bytes):
+            return True
+        return False
+
+    def _checkpoint_event(self, eventtime):
+        try:
+            print_stats = self.print_stats.get_status(eventtime)
+            if (print_stats['state'] == "printing" and not self.is_recovering
+                    and self._checkpoint_due(eventtime, print_stats)):
+                self._write_checkpoint(eventtime, True)
+        except Exception:
+            logging.exception("power loss checkpoint")
+        return eventtime + CHECKPOINT_POLL_TIME
+
     cmd_F103_help = "Save power loss info"
     def cmd_F103(self, gcmd):
         reactor = self.printer.get_reactor()
+        eventtime = reactor.monotonic()
         try:
-            print_stats = self.print_stats.get_status(reactor.monotonic())
+            print_stats = self.print_stats.get_status(eventtime)
+            if self.is_recovering:
+                # F102 is still restoring the print state
+                return
             if print_stats['state'] == "printing" :
-                newvars = dict()
-                newvars['was_interrupted'] = True
-                
-                v_sd_stats = self.v_sd.get_status(reactor.monotonic())
-                newvars['sd_filename'] = str(v_sd_stats['file_path'])
-                newvars['file_position'] = v_sd_stats['file_position']
-
-                gcode_move = self.gcode_move.get_status(reactor.monotonic())
-                gcode_position = gcode_move['gcode_position']
-                newvars['e_pos'] = gcode_position.e
-                newvars['x_pos'] = gcode_position.x
-                newvars['y_pos'] = gcode_position.y
-                newvars['z_pos'] = gcode_position.z
-                newvars['absolute_extrude'] = gcode_move['absolute_extrude']
-                newvars['absolute_coordinates'] = gcode_move['absolute_coordinates']
-
-                newvars['print_duration'] = print_stats['print_duration']
-                newvars['filament_used'] = float(print_stats['filament_used'])
-                fan_max_power = max(0.1, float(self.fan.get_status(reactor.monotonic())['max_power']))
-                newvars['fan_speed'] = float(self.fan.get_status(reactor.monotonic())['speed'])/fan_max_power
-                # newvars['max_power_factor'] = float(self.fan.get_status(reactor.monotonic())['max_power_factor'])
-
-                newvars['nozzle_temp'] = float(self.extruder.get_status(reactor.monotonic())['target'])
-                newvars['bed_temp'] = float(self.heater_bed.get_status(reactor.monotonic())['target'])
-                #每一层要保存一下零件跳过的信息
-                newvars['excluded_objects'] = self.exclude_object.get_status(reactor.monotonic())['excluded_objects']
-                # newvars['objects'] = self.exclude_object.get_status(reactor.monotonic())['objects']
-                newvars['objects_enabled'] = self.exclude_object.get_status(reactor.monotonic())['enabled']
-                
-                self.save_variables.setVariables(newvars, gcmd)
+                if (eventtime - self.last_checkpoint_time
+                        < self.checkpoint_min_interval):
+                    # Bound the checkpoint rate on short layers; the
+                    # scheduler writes the record once allowed
+                    self.checkpoint_pending = True
+                    return
+                self._write_checkpoint(eventtime, False)
             else:
                 logging.info(f"print_stats.state = {print_stats['state']}, not printing")
         except Exception as e:
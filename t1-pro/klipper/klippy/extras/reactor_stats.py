@@ -0,0 +1,53 @@
+# Report reactor timer lateness and callback run times
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class PrinterReactorStats:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/stats", self._handle_stats)
+        self.reactor.set_stats_enabled(config.getboolean('enabled', False))
+    def _get_summary(self):
+        total, idle = self.reactor.get_greenlet_counts()
+        summary = {'enabled': False}
+        rstats = self.reactor.get_stats()
+        if rstats is not None:
+            summary = rstats.get_summary()
+            summary['enabled'] = True
+        summary['greenlets'] = total
+        summary['idle_greenlets'] = idle
+        return summary
+    def _handle_stats(self, web_request):
+        enable = web_request.get('enable', None)
+        if enable is not None:
+            self.reactor.set_stats_enabled(not not enable)
+        rstats = self.reactor.get_stats()
+        if rstats is not None and web_request.get('reset', False):
+            rstats.reset()
+        web_request.send(self._get_summary())
+    def stats(self, eventtime):
+        total, idle = self.reactor.get_greenlet_counts()
+        msg = "greenlets=%d" % (total - idle,)
+        rstats = self.reactor.get_stats()
+        if rstats is not None:
+            # Worst values since the previous stats line
+            lateness, duration, name = rstats.take_interval()
+            msg += " reactor_late=%.3f reactor_slow=%s:%.3f" % (
+                lateness, name, duration)
+        return False, msg
+    def get_status(self, eventtime):
+        total, idle = self.reactor.get_greenlet_counts()
+        status = {'enabled': False, 'greenlets': total,
+                  'idle_greenlets': idle}
+        rstats = self.reactor.get_stats()
+        if rstats is not None:
+            status.update({'enabled': True,
+                           'max_lateness': rstats.max_lateness,
+                           'max_lateness_callback': rstats.max_lateness_name,
+                           'pause_time': rstats.pause_time})
+        return status
+
+def load_config(config):
+    return PrinterReactorStats(config)
@@ -180,11 +180,11 @@ class ResonanceTester:
                 if accel_chips is None:
                     for chip_axis, chip in self.accel_chips:
                         if axis.matches(chip_axis):
-                            aclient = chip.start_internal_client()
+                            aclient = chip.start_internal_client(want_psd=True)
                             raw_values.append((chip_axis, aclient, chip.name))
                 else:
                     for chip in accel_chips:
-                        aclient = chip.start_internal_client()
+                        aclient = chip.start_internal_client(want_psd=True)
                         raw_values.append((axis, aclient, chip.name))
 
                 # Generate moves
@@ -15,6 +15,15 @@ TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Streamed samples are only added to the PSD once they are this old, as
+# the samples after the end of the test are discarded
+ACCUMULATE_DELAY = 1.
+
+# Size of the PSD windows, rounded up to the nearest power of 2 for
+# faster FFT
+def calc_window_size(sampling_freq):
+    return 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
@@ -53,6 +62,64 @@ class CalibrationData:
         return self._psd_map[axis]
 
 
+# Welch's PSD calculated while accelerometer samples are streamed in.
+# The result matches ShaperCalibrate.calc_freq_response() for the same
+# samples.
+class PSDAccumulator:
+    def __init__(self, numpy, nominal_freq):
+        self.numpy = numpy
+        self.nfft = nfft = calc_window_size(nominal_freq)
+        self.window = numpy.kaiser(nfft, 6.)
+        self.psd_sum = numpy.zeros((nfft // 2 + 1, 3))
+        self.windows = 0
+        self.next_start = 0
+        self.last_time = 0.
+    def _add_windows(self, data, end):
+        # Add the windows of data[:end] that were not processed yet
+        np = self.numpy
+        nfft = self.nfft
+        overlap = nfft // 2
+        step = nfft - overlap
+        count = (end - self.next_start - overlap) // step
+        if count <= 0:
+            return
+        for axis in range(3):
+            x = data[self.next_start:, axis + 1]
+            shape = (nfft, count)
+            strides = (x.strides[-1], step * x.strides[-1])
+            x = np.lib.stride_tricks.as_strided(
+                    x, shape=shape, strides=strides, writeable=False)
+            x = self.window[:, None] * (x - np.mean(x, axis=0))
+            result = np.fft.rfft(x, n=nfft, axis=0)
+            result = np.conjugate(result) * result
+            self.psd_sum[:, axis] += result.real.sum(axis=-1)
+        self.windows += count
+        self.next_start += count * step
+        self.last_time = data[self.next_start - step + nfft - 1, 0]
+    def update(self, data):
+        if not len(data):
+            return
+        end = self.numpy.searchsorted(
+                data[:, 0], data[-1, 0] - ACCUMULATE_DELAY, side='right')
+        self._add_windows(data, end)
+    def get_calibration_data(self, data):
+        # Returns None if the samples do not allow a streamed result
+        np = self.numpy
+        N = data.shape[0]
+        T = data[-1,0] - data[0,0]
+        SAMPLING_FREQ = N / T
+        if (calc_window_size(SAMPLING_FREQ) != self.nfft or N <= self.nfft
+                or self.last_time > data[-1,0]):
+            return None
+        self._add_windows(data, N)
+        scale = 1.0 / (self.window**2).sum()
+        psd = self.psd_sum * (scale / SAMPLING_FREQ / self.windows)
+        psd[1:-1,:] *= 2.
+        freqs = np.fft.rfftfreq(self.nfft, 1. / SAMPLING_FREQ)
+        px, py, pz = [psd[:,axis].copy() for axis in range(3)]
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
@@ -153,15 +220,22 @@ class ShaperCalibrate:
             data = raw_values
         else:
             samples = raw_values.get_samples()
-            if not samples:
+            if not len(samples):
                 return None
+            psd_acc = None
+            if hasattr(raw_values, 'get_psd_accumulator'):
+                psd_acc = raw_values.get_psd_accumulator()
+            if psd_acc is not None:
+                # Most of the PSD was calculated during the test
+                calibration_data = psd_acc.get_calibration_data(samples)
+                if calibration_data is not None:
+                    return calibration_data
             data = np.array(samples)
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
         SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        M = calc_window_size(SAMPLING_FREQ)
         if N <= M:
             return None
 
@@ -0,0 +1,118 @@
+# XY size compensation applied to G-Code moves
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+# The calibration print has six 70mm blocks (see SIZE_ANALYZE).  Inside
+# 72mm the measured block sizes of the sector containing the move are
+# used directly; outside it the smaller of the average sizes is used.
+# Within each quadrant half the sizes of the neighbouring blocks are
+# blended according to the angle of the move.  The sector boundaries are
+# not continuous, so the offsets are evaluated exactly per move rather
+# than interpolated from a grid.
+INNER_RADIUS = 72.
+BLOCK_SIZE = 70.
+
+# Blend weights: t, t+60 and 60-t where t is 60 times the tangent of
+# the angle to the nearest axis
+W_T, W_TP, W_TM = 0, 1, 2
+
+class SizeCompensation:
+    def __init__(self, x_size, y_size, max_offset):
+        self.max_offset = max_offset
+        x0, x1, x2, x3, x4, x5 = x_size
+        y0, y1, y2, y3, y4, y5 = y_size
+        self.x23 = x2 + x3
+        self.y23 = y2 + y3
+        self.x14 = x1 + x4
+        self.y14 = y1 + y4
+        self.x05 = x0 + x5
+        self.y05 = y0 + y5
+        self.x2, self.x3, self.y2, self.y3 = x2, x3, y2, y3
+        self.outer_x = min((x0 + x1 + x4 + x5) * .25, self.x23 * .5)
+        self.outer_y = min((y0 + y1 + y4 + y5) * .25, self.y23 * .5)
+        # Per sector (base, delta, weight, divisor) of the blended x
+        # numerator, x remainder, y numerator and y remainder sizes.
+        # Sectors are ordered by quadrant (+X+Y, +X-Y, -X+Y, -X-Y) and
+        # then by whether |X| > |Y|.
+        self.sectors = (
+            ((x3, x1-x3, W_T, 60.), (x2, x4-x2, W_T, 60.),
+             (y4, y5-y4, W_TM, 120.), (y0, y1-y0, W_TP, 120.)),
+            ((x0, x1-x0, W_TP, 120.), (x4, x5-x4, W_TM, 120.),
+             (y4, y2-y4, W_TM, 60.), (y3, y1-y3, W_T, 60.)),
+            ((x3, x5-x3, W_T, 60.), (x2, x0-x2, W_T, 60.),
+             (y4, y5-y4, W_TM, 120.), (y0, y1-y0, W_TM, 120.)),
+            ((x4, x5-x4, W_TP, 120.), (x0, x1-x0, W_TM, 120.),
+             (y5, y3-y5, W_TM, 60.), (y2, y0-y2, W_T, 60.)),
+            ((x2, x0-x2, W_T, 60.), (x3, x5-x3, W_T, 60.),
+             (y0, y1-y0, W_TM, 120.), (y4, y5-y4, W_TM, 120.)),
+            ((x0, x1-x0, W_TM, 120.), (x4, x5-x4, W_TP, 120.),
+             (y2, y0-y2, W_T, 60.), (y5, y3-y5, W_TM, 60.)),
+            ((x4, x5-x4, W_TM, 120.), (x0, x1-x0, W_TP, 120.),
+             (y0, y1-y0, W_TP, 120.), (y4, y5-y4, W_TM, 120.)),
+            ((x4, x5-x4, W_TM, 120.), (x0, x1-x0, W_TP, 120.),
+             (y3, y1-y3, W_T, 60.), (y4, y2-y4, W_TM, 60.)))
+    def _get_scale(self, x, y, ax, ay):
+        if ax > INNER_RADIUS or ay > INNER_RADIUS:
+            return ((x + x) * self.outer_x / BLOCK_SIZE,
+                    (y + y) * self.outer_y / BLOCK_SIZE)
+        if ax < .1 or ay / ax >= 2.:
+            ky = self.y23 * y / BLOCK_SIZE
+        else:
+            r = y / x
+            ky = (self.y14 if r < -2. or r > 0. else self.y05) * y / BLOCK_SIZE
+        if ay < .1 or ax / ay >= 2.:
+            kx = self.x23 * x / BLOCK_SIZE
+        else:
+            r = x / y
+            kx = (self.x14 if r < -2. or r > 0. else self.x05) * x / BLOCK_SIZE
+        return kx, ky
+    def get_offsets(self, x, y):
+        ax = abs(x)
+        ay = abs(y)
+        kx, ky = self._get_scale(x, y, ax, ay)
+        if not x or not y:
+            # Moves along an axis only use the two central blocks
+            x_offset = y_offset = 0.
+            if ay >= .01:
+                size = self.y2 if y > 0. else self.y3
+                y_offset = (ay - abs(size * ky / self.y23)) / ay
+            elif x:
+                size = self.x3 if x > 0. else self.x2
+                x_offset = (ax - abs(size * kx / self.x23)) / ax
+        else:
+            sector = (x < 0.) * 4 + (y < 0.) * 2 + (ax <= ay)
+            if ax > ay:
+                t = abs(y * 60. / x)
+            else:
+                t = abs(x * 60. / y)
+            w = (t, t + 60., 60. - t)
+            (a, ad, aw, adiv), (b, bd, bw, bdiv), (c, cd, cw, cdiv), (
+                d, dd, dw, ddiv) = self.sectors[sector]
+            a += ad * w[aw] / adiv
+            b += bd * w[bw] / bdiv
+            c += cd * w[cw] / cdiv
+            d += dd * w[dw] / ddiv
+            x_offset = (ax - abs(kx * a / (a + b))) / ax
+            y_offset = (ay - abs(ky * c / (c + d))) / ay
+        max_offset = self.max_offset
+        if max_offset < abs(x_offset):
+            x_offset = max_offset * x_offset / abs(x_offset)
+        if max_offset < abs(y_offset):
+            y_offset = max_offset * y_offset / abs(y_offset)
+        return x_offset, y_offset
+    def calc_position(self, pos):
+        x_offset, y_offset = self.get_offsets(pos[0], pos[1])
+        return [pos[0] * (1 + x_offset), pos[1] * (1 + y_offset),
+                pos[2], pos[3]]
+
+# Same interface for the "integrated" calibration mode, which uses a
+# single offset per axis for the whole bed
+class FixedSizeCompensation:
+    def __init__(self, x_offset, y_offset):
+        self.x_offset = x_offset
+        self.y_offset = y_offset
+    def get_offsets(self, x, y):
+        return self.x_offset, self.y_offset
+    def calc_position(self, pos):
+        return [pos[0] * (1 + self.x_offset), pos[1] * (1 + self.y_offset),
+                pos[2], pos[3]]
@@ -0,0 +1,166 @@
+# Sampling profiler for the reactor thread with folded stack output
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, threading, time, logging
+
+# The samples are taken by a background thread reading the current
+# frame of the reactor thread.  A SIGPROF timer is not used as the
+# signal may interrupt the poll() of the C helper threads, which treat
+# that as a fatal error.  Stacks of a greenlet end at its run function,
+# so samples of paused reactor greenlets and of the main greenlet are
+# kept apart.
+
+class SamplerThread:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.sample_count = self.idle_count = 0
+        self.must_stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def _run(self):
+        counts = self.counts
+        thread_id = self.thread_id
+        while not self.must_stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            self.sample_count += 1
+            top = frame.f_code
+            if (top.co_name in ('_dispatch_loop', '_sys_pause')
+                and top.co_filename.endswith('reactor.py')):
+                # Waiting for events
+                self.idle_count += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack = tuple(stack)
+            counts[stack] = counts.get(stack, 0) + 1
+    def stop(self):
+        self.must_stop.set()
+        self.thread.join()
+
+def format_code(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+class StackProfiler:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.interval = config.getfloat('interval', .005, minval=.001)
+        log_file = self.printer.get_start_args().get('log_file')
+        default_dir = "/tmp"
+        if log_file is not None:
+            default_dir = os.path.dirname(os.path.abspath(log_file))
+        self.output_dir = os.path.expanduser(
+            config.get('output_dir', default_dir))
+        self.sampler = None
+        self.stop_timer = None
+        self.last_file = None
+        self.last_samples = 0
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("STACK_PROFILE", self.cmd_STACK_PROFILE,
+                               desc=self.cmd_STACK_PROFILE_help)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("stack_profile", self._handle_profile)
+    def _handle_disconnect(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+    def start(self, duration=0.):
+        if self.sampler is None:
+            self.sampler = SamplerThread(threading.get_ident(), self.interval)
+            logging.info("stack_profiler: started (interval %.3fs)",
+                         self.interval)
+        if self.stop_timer is not None:
+            self.reactor.unregister_timer(self.stop_timer)
+            self.stop_timer = None
+        if duration:
+            waketime = self.reactor.monotonic() + duration
+            self.stop_timer = self.reactor.register_timer(self._stop_event,
+                                                          waketime)
+    def _stop_event(self, eventtime):
+        self.stop_timer = None
+        self.stop()
+        return self.reactor.NEVER
+    def stop(self):
+        if self.stop_timer is not None:
+            self.reactor.unregister_timer(self.stop_timer)
+            self.stop_timer = None
+        sampler = self.sampler
+        if sampler is None:
+            return None
+        self.sampler = None
+        sampler.stop()
+        self.last_samples = sampler.sample_count
+        self.last_file = self._write_folded(sampler)
+        return self.last_file
+    def _write_folded(self, sampler):
+        names = {}
+        lines = []
+        for stack, count in sampler.counts.items():
+            frames = []
+            for code in reversed(stack):
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = format_code(code)
+                frames.append(name)
+            if stack[-1].co_name == '<module>':
+                frames.insert(0, "[main]")
+            else:
+                frames.insert(0, "[greenlet]")
+            lines.append("%s %d" % (";".join(frames), count))
+        if sampler.idle_count:
+            lines.append("[idle] %d" % (sampler.idle_count,))
+        lines.sort()
+        fname = os.path.join(self.output_dir, "stack_profile-%s.folded" % (
+            time.strftime("%Y%m%d-%H%M%S"),))
+        try:
+            f = open(fname, 'w')
+            f.write("\n".join(lines) + "\n")
+            f.close()
+        except IOError:
+            logging.exception("stack_profiler: Unable to write %s", fname)
+            return None
+        logging.info("stack_profiler: %d samples written to %s",
+                     sampler.sample_count, fname)
+        return fname
+    def get_status(self, eventtime):
+        samples = self.last_samples
+        if self.sampler is not None:
+            samples = self.sampler.sample_count
+        return {'enabled': self.sampler is not None, 'samples': samples,
+                'last_file': self.last_file}
+    def _handle_profile(self, web_request):
+        enable = web_request.get('enable', None)
+        if enable is not None:
+            if enable:
+                self.start(web_request.get_float('duration', 0.))
+            else:
+                self.stop()
+        web_request.send(self.get_status(self.reactor.monotonic()))
+    cmd_STACK_PROFILE_help = "Start or stop the sampling stack profiler"
+    def cmd_STACK_PROFILE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if enable:
+            self.start(gcmd.get_float('DURATION', 0., minval=0.))
+        elif enable is not None:
+            if self.sampler is None:
+                raise gcmd.error("Stack profiler is not running")
+            self.stop()
+        status = self.get_status(self.reactor.monotonic())
+        msg = "Stack profiler %s: %d samples" % (
+            ["stopped", "running"][status['enabled']], status['samples'])
+        if status['last_file'] is not None and not status['enabled']:
+            msg += " (%s)" % (status['last_file'],)
+        gcmd.respond_info(msg)
+
+def load_config(config):
+    return StackProfiler(config)
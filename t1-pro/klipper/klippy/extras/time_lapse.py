@@ -0,0 +1,133 @@
+# Persistent worker for time-lapse frame capture
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, logging, subprocess, collections
+
+# The worker is a small shell loop that runs the capture scripts on
+# behalf of klippy and acknowledges each request on stdout.
+WORKER_SCRIPT = """
+while read -r req; do
+    case "$req" in
+        capture) bash "$1" </dev/null >/dev/null 2>&1 ;;
+        init) bash "$2" </dev/null >/dev/null 2>&1 ;;
+    esac
+    echo "$req"
+done
+"""
+
+class TimeLapse:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.capture_script = config.get(
+            'capture_script', '/home/pi/flsun_func/time_lapse/time_lapse.sh')
+        self.init_script = config.get(
+            'init_script', '/home/pi/flsun_func/time_lapse/time_lapse_init.sh')
+        self.queue_size = config.getint('queue_size', 2, minval=1)
+        self.proc = None
+        self.fd_handle = None
+        self.partial_input = b""
+        # Requests sent to the worker and not yet acknowledged
+        self.pending = collections.deque()
+        self.frames_requested = self.frames_captured = 0
+        self.frames_dropped = 0
+        self.last_latency = self.max_latency = 0.
+        self.printer.register_event_handler("klippy:ready", self._handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+    def _handle_ready(self):
+        self._start_worker()
+    def _handle_disconnect(self):
+        self._stop_worker()
+    def _start_worker(self):
+        # Fork once, outside of any print, instead of once per frame
+        try:
+            self.proc = subprocess.Popen(
+                ["bash", "-c", WORKER_SCRIPT, "time_lapse",
+                 self.capture_script, self.init_script],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, close_fds=True)
+        except OSError:
+            logging.exception("time_lapse: unable to start capture worker")
+            self.proc = None
+            return
+        os.set_blocking(self.proc.stdin.fileno(), False)
+        self.fd_handle = self.reactor.register_fd(self.proc.stdout.fileno(),
+                                                  self._process_ack)
+        self.partial_input = b""
+        self.pending.clear()
+    def _stop_worker(self):
+        if self.proc is None:
+            return
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+        # The worker exits once its input is closed
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except OSError:
+                pass
+        self.proc.poll()
+        self.proc = None
+        self.pending.clear()
+    def _process_ack(self, eventtime):
+        try:
+            data = os.read(self.proc.stdout.fileno(), 4096)
+        except OSError:
+            logging.exception("time_lapse: read from capture worker")
+            data = b""
+        if not data:
+            logging.info("time_lapse: capture worker exited")
+            self._stop_worker()
+            return
+        lines = (self.partial_input + data).split(b'\n')
+        self.partial_input = lines.pop()
+        for line in lines:
+            if not self.pending:
+                break
+            req, req_time = self.pending.popleft()
+            if req == 'capture':
+                self.frames_captured += 1
+                self.last_latency = eventtime - req_time
+                self.max_latency = max(self.max_latency, self.last_latency)
+    def _send(self, req):
+        if self.proc is None:
+            return False
+        try:
+            os.write(self.proc.stdin.fileno(), req.encode() + b'\n')
+        except BlockingIOError:
+            return False
+        except OSError:
+            logging.exception("time_lapse: write to capture worker")
+            self._stop_worker()
+            return False
+        self.pending.append((req, self.reactor.monotonic()))
+        return True
+    def request_frame(self):
+        # Drop the frame rather than queue up behind a slow capture
+        self.frames_requested += 1
+        captures = sum(1 for req, t in self.pending if req == 'capture')
+        if captures >= self.queue_size or not self._send('capture'):
+            self.frames_dropped += 1
+    def start_print(self):
+        # A worker that exited is only restarted here, before a print
+        if self.proc is None:
+            self._start_worker()
+        # An init that was not acknowledged yet also covers this print
+        if any(req == 'init' for req, t in self.pending):
+            return
+        if not self._send('init'):
+            logging.info("time_lapse: unable to queue init request")
+    def get_status(self, eventtime):
+        return {
+            'frames_requested': self.frames_requested,
+            'frames_captured': self.frames_captured,
+            'frames_dropped': self.frames_dropped,
+            'pending': len(self.pending),
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+        }
+
+def load_config(config):
+    return TimeLapse(config)
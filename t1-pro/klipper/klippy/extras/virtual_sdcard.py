@@ -3,12 +3,10 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, threading
-import subprocess #flsun add
+import os, logging, threading, collections
 import sys #flsun add
 import importlib #flsun add
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+from . import gcode_index
 importlib.reload(sys) #flsun add
 #sys.setdefaultencoding('utf8') #flsun add ,add the three line to support Chinese,now don't need it because klipper use python3
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
@@ -31,6 +29,97 @@ TIMELAPSE_RENDER
 M73 P100 R0
 """
 
+# Background read-ahead of the file being printed.  A helper thread
+# keeps up to 'depth' chunks queued ahead of the reader so that slow
+# media never blocks the reactor; reset() invalidates queued data.
+class FilePrefetcher:
+    def __init__(self, reactor, chunk_size, depth, fadvise):
+        self.reactor = reactor
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.fadvise = fadvise
+        self.lock = threading.Condition()
+        self.chunks = collections.deque()
+        self.generation = 0
+        self.fd = None
+        self.read_pos = 0
+        self.at_eof = False
+        self.read_error = None
+        self.waiter = None
+        self.is_running = True
+        self.thread = threading.Thread(target=self._bg_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def reset(self, fileobj, position):
+        fd = None
+        if fileobj is not None:
+            fd = fileobj.fileno()
+            if self.fadvise and hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(fd, position, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+        with self.lock:
+            self.generation += 1
+            self.chunks.clear()
+            self.fd = fd
+            self.read_pos = position
+            self.at_eof = False
+            self.read_error = None
+            self.lock.notify()
+    def stop(self):
+        self.reset(None, 0)
+    def shutdown(self):
+        with self.lock:
+            self.is_running = False
+            self.lock.notify()
+        self.thread.join(timeout=0.2)
+    def _bg_thread(self):
+        while 1:
+            with self.lock:
+                while self.is_running and (
+                        self.fd is None or self.at_eof
+                        or self.read_error is not None
+                        or len(self.chunks) >= self.depth):
+                    self.lock.wait()
+                if not self.is_running:
+                    return
+                generation, fd, pos = self.generation, self.fd, self.read_pos
+            data = error = None
+            try:
+                data = os.pread(fd, self.chunk_size, pos)
+            except Exception as e:
+                error = "virtual_sdcard read error: %s" % (e,)
+            with self.lock:
+                if generation != self.generation:
+                    # File position changed while reading - discard
+                    continue
+                if error is not None:
+                    self.read_error = error
+                else:
+                    self.chunks.append(data)
+                    self.read_pos = pos + len(data)
+                    self.at_eof = not data
+                waiter, self.waiter = self.waiter, None
+            if waiter is not None:
+                self.reactor.async_complete(waiter, None)
+    def read(self):
+        while 1:
+            with self.lock:
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.lock.notify()
+                    return data
+                if self.read_error is not None:
+                    raise IOError(self.read_error)
+                if self.fd is None:
+                    raise IOError("Error: File closed")
+                self.waiter = completion = self.reactor.completion()
+            res = completion.wait(self.reactor.monotonic() + 1.0, False)
+            if res is False:
+                logging.info("Read thread is still working")
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -48,7 +137,10 @@ class VirtualSD:
         self.reactor = self.printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
+        self.must_seek = False
         self.work_timer = None
+        self.dispatch_batch_lines = config.getint('dispatch_batch_lines', 64,
+                                                  minval=1)
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -65,10 +157,22 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command(
+            "SDCARD_SEEK_LAYER", self.cmd_SDCARD_SEEK_LAYER,
+            desc=self.cmd_SDCARD_SEEK_LAYER_help)
+        # Layer/object offset index of the loaded file
+        self.file_index = None
+        self.index_builder = None
         self.exclude_object_gcode = gcode_macro.load_template(
             config, 'gcode', DEFAULT_ExcludeObject_GCODE)
 
-        self.thread_pool = ThreadPoolExecutor(max_workers=1)
+        self.prefetch = FilePrefetcher(
+            self.reactor,
+            config.getint('read_ahead_chunk_size', 65536, minval=4096),
+            config.getint('read_ahead_chunks', 4, minval=1),
+            config.getboolean('read_ahead_fadvise', True))
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self.prefetch.shutdown)
         self.exclude_object = self.printer.load_object(config, 'exclude_object')
     def handle_shutdown(self):
         if self.work_timer is not None:
@@ -159,6 +263,7 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0.
+        self.file_index = None
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -222,10 +327,11 @@ class VirtualSD:
             raise gcmd.error("Unable to open file")
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
-        subprocess.Popen(["bash", "/home/pi/flsun_func/time_lapse/time_lapse_init.sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) #flsun add
+        self.printer.lookup_object('time_lapse').start_print()
         self.current_file = f
         self.file_position = int(fileposition) #wzy modify
         self.file_size = fsize
+        self._load_index(fname)
         self.print_stats.set_current_file(filename)
         # start print，default set power loss flag to 0
         #flsun add, run START_PRINT when start a print
@@ -239,6 +345,16 @@ class VirtualSD:
         else:#gfh modify
             self.power_loss_restart = 1
 
+    def _load_index(self, fname):
+        self.file_index = gcode_index.load_index(fname)
+        if self.file_index is None and self.index_builder is None:
+            # Index the file in the background on its first print
+            self.index_builder = gcode_index.IndexBuilder(
+                self.reactor, fname, self._handle_index_built)
+    def _handle_index_built(self, fname, file_index):
+        self.index_builder = None
+        if file_index is not None and self.file_path() == fname:
+            self.file_index = file_index
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         self.do_resume()
@@ -258,6 +374,23 @@ class VirtualSD:
             return
         gcmd.respond_raw("SD printing byte %d/%d"
                          % (self.file_position, self.file_size))
+    cmd_SDCARD_SEEK_LAYER_help = "Set the SD position to the start of a layer"
+    def cmd_SDCARD_SEEK_LAYER(self, gcmd):
+        if self.work_timer is not None:
+            raise gcmd.error("SD busy")
+        if self.current_file is None:
+            raise gcmd.error("No SD file loaded")
+        if self.file_index is None:
+            raise gcmd.error("SD file index not available")
+        layer = gcmd.get_int('LAYER', minval=0)
+        info = self.file_index.get_layer(layer)
+        if info is None:
+            raise gcmd.error("Layer %d not found (file has %d layers)"
+                             % (layer, self.file_index.get_layer_count()))
+        offset, z, line, e_pos, filament = info
+        self.file_position = offset
+        gcmd.respond_info("Layer %d: byte %d line %d Z=%.3f E=%.5f"
+                          % (layer, offset, line + 1, z, e_pos))
     def get_file_position(self):
         return self.next_file_position
     def set_file_position(self, pos):
@@ -270,39 +403,14 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
-    def _thread_read_handler(self,read_data):
-        try:
-            if self.current_file is None:
-                read_data['result'] = "Error: File closed"
-                return 
-            read_data['data'] = self.current_file.read(8192)
-        except:
-            logging.exception("virtual_sdcard read")
-            read_data['result'] = "virtual_sdcard read error"
-            return
-    
     def _read_data(self):
-        thread_read = {"data": b"","result": None}
-        future = self.thread_pool.submit(
-            self._thread_read_handler,
-            thread_read
-        )
-        while True:
-            try:
-                result = future.result(timeout=1.0)
-                break
-            except TimeoutError:
-                logging.info("Read thread is still working")
-                self.reactor.pause(self.reactor.monotonic() + 0.01)
-                continue
-            else:
-                break
-            
-        if thread_read['result']:
-            raise thread_read['result']
+        if self.current_file is None:
+            raise IOError("Error: File closed")
+        return self.prefetch.read()
+    def _seek_file(self, pos):
+        self.current_file.seek(pos)
+        self.prefetch.reset(self.current_file, pos)
 
-        return thread_read['data']
-		
     def _recover_file_position(self, file_position):
         end_flag = False
         end_position = file_position
@@ -329,6 +437,15 @@ class VirtualSD:
 
     def recover_file_position(self, original_file_position):
         if len(self.exclude_object.excluded_objects) > 0:
+            if self.file_index is not None:
+                end_position = self.file_index.find_object_start(
+                    original_file_position)
+                if end_position is None:
+                    self.current_file.seek(original_file_position)
+                    return original_file_position
+                self.current_file.seek(end_position)
+                self.exclude_object.initial_extrusion_moves = 0
+                return end_position
             file_position = original_file_position
             end_flag, end_position = False, file_position
             while True:
@@ -348,6 +465,34 @@ class VirtualSD:
         else:
             return original_file_position
 
+    def _dispatch_lines(self, lines, locate_printing_gcode):
+        # Generate lines for a single gcode.run_script_lines() call.  The
+        # file position is advanced after each line completes, and the
+        # batch ends early on a pause request, a pending mutex waiter, or
+        # a file position change made by the last command.
+        gcode_mutex = self.gcode.get_mutex()
+        count = 0
+        while lines and not self.must_pause_work:
+            if count >= self.dispatch_batch_lines or (
+                    count and gcode_mutex.test_waiting()):
+                break
+            self.cmd_from_sd = True
+            line = lines.pop()
+            next_file_position = self.file_position + len(line) + 1
+            self.next_file_position = next_file_position
+            line = line.decode('utf-8')
+            if locate_printing_gcode is not None:
+                # 记录gcode_缓冲
+                locate_printing_gcode.record_gcode_begin(line, self.file_position)
+            yield line
+            if locate_printing_gcode is not None:
+                locate_printing_gcode.record_gcode_end()
+            self.cmd_from_sd = False
+            self.file_position = self.next_file_position
+            count += 1
+            if self.next_file_position != next_file_position:
+                self.must_seek = True
+                break
     def work_handler(self, eventtime):
         has_pre_check = False
         logging.info("Starting SD card print (position %d)", self.file_position)
@@ -373,6 +518,12 @@ class VirtualSD:
             #recover file_position
             self.file_position = self.recover_file_position(self.file_position)
             #recover file_position end
+        try:
+            self._seek_file(self.file_position)
+        except:
+            logging.exception("virtual_sdcard seek")
+            self.work_timer = None
+            return self.reactor.NEVER
         gcode_mutex = self.gcode.get_mutex()
         partial_input = b""
         lines = []
@@ -411,25 +562,18 @@ class VirtualSD:
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
-            self.cmd_from_sd = True
-            line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
+            if not has_pre_check:
+                has_pre_check = True
+                #filament check
+                filament_sensor = self.printer.lookup_object("filament_switch_sensor filament_sensor")
+                runout_helper = filament_sensor.runout_helper
+                if runout_helper.check_to_pause():
+                    break
+            # Dispatch a batch of commands
+            self.must_seek = False
             try:
-                if not has_pre_check:
-                    has_pre_check = True
-                    #filament check
-                    filament_sensor = self.printer.lookup_object("filament_switch_sensor filament_sensor")
-                    runout_helper = filament_sensor.runout_helper
-                    if runout_helper.check_to_pause():
-                        break
-                if locate_printing_gcode is not None:
-                    # 记录gcode_缓冲
-                    locate_printing_gcode.record_gcode_begin(line.decode('utf-8'), self.file_position)
-                self.gcode.run_script(line.decode('utf-8'))
-                if locate_printing_gcode is not None:
-                    locate_printing_gcode.record_gcode_end()
+                self.gcode.run_script_lines(
+                    self._dispatch_lines(lines, locate_printing_gcode))
             except self.gcode.error as e:
                 error_message = str(e)
                 if "exclude_object over" in str(e):
@@ -438,7 +582,7 @@ class VirtualSD:
                         self.gcode.run_script(self.exclude_object_gcode.render())
                     except:
                         logging.exception("exclude_object gcode running error") 
-                    self.current_file.seek(self.file_position)
+                    self._seek_file(self.file_position)
                     error_message = None
                     continue
                 try:
@@ -449,19 +593,18 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard dispatch")
                 break
-            self.cmd_from_sd = False
-            self.file_position = self.next_file_position
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if self.must_seek:
                 try:
-                    self.current_file.seek(self.file_position)
+                    self._seek_file(self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
                     self.work_timer = None
                     return self.reactor.NEVER
                 lines = []
-                partial_input = ""
+                partial_input = b""
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        self.prefetch.stop()
         self.work_timer = None
         self.cmd_from_sd = False
         if error_message is not None:
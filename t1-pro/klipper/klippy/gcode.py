@@ -105,6 +105,8 @@ class GCodeDispatch:
         self.output_callbacks = []
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
+        self.fast_handlers = {}
+        self.profiler = None
         self.mux_commands = {}
         self.gcode_help = {}
         # Register commands needed before config file is loaded
@@ -129,6 +131,7 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
+            self.fast_handlers.pop(cmd, None)
             return old_cmd
         if cmd in self.ready_gcode_handlers:
             raise self.printer.config_error(
@@ -141,6 +144,16 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_fast_command(self, cmd, func):
+        # Optional handler for plain "CMD A1 B2.5" lines of a registered
+        # traditional command.  It is called with a dict of float
+        # parameters (without the command itself) and may return False
+        # to have the line processed by the regular handler instead.
+        self.fast_handlers[cmd] = (self.ready_gcode_handlers[cmd], func)
+    def set_profiler(self, profiler):
+        # The profiler's note_command(cmd, start_time) is invoked after
+        # each command, with start_time from profiler.monotonic()
+        self.profiler = profiler
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -176,6 +189,35 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_cmd_r = re.compile(
+        r'([A-Z][0-9]+)((?:\s*[A-Z]\s*[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))*)\s*$')
+    fast_param_r = re.compile(r'([A-Z])\s*([-+.0-9]+)')
+    def _get_fast_handler(self, line):
+        m = self.fast_cmd_r.match(line)
+        if m is None:
+            return "", None, None
+        cmd = m.group(1)
+        fast = self.fast_handlers.get(cmd)
+        if fast is None or self.gcode_handlers.get(cmd) is not fast[0]:
+            # Not ready, or the command was overridden (eg, by a macro)
+            return "", None, None
+        params = {p: float(v) for p, v in self.fast_param_r.findall(
+            m.group(2))}
+        return cmd, fast[1], params
+    def _parse_command(self, line, origline, need_ack):
+        # Break line into parts and determine command
+        parts = self.args_r.split(line.upper())
+        numparts = len(parts)
+        cmd = ""
+        if numparts >= 3 and parts[1] != 'N':
+            cmd = parts[1] + parts[2].strip()
+        elif numparts >= 5 and parts[1] == 'N':
+            # Skip line number at start of command
+            cmd = parts[3] + parts[4].strip()
+        # Build gcode "params" dictionary
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, numparts, 2) }
+        return GCodeCommand(self, cmd, origline, params, need_ack)
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
@@ -186,23 +228,20 @@ class GCodeDispatch:
             if len(line) > 2 and self.print_stats != None and self.print_stats.state != 'printing' :
                 #record gcode if not on printing state
                 logging.info('gcode:'+line)
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
-            # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
+            # Plain moves and similar hot commands skip GCodeCommand
+            cmd, fast_handler, fast_params = self._get_fast_handler(line)
+            gcmd = None
+            profiler = self.profiler
+            if profiler is not None:
+                start_time = profiler.monotonic()
             try:
-                handler(gcmd)
+                if (fast_handler is None
+                    or fast_handler(fast_params) is False):
+                    gcmd = self._parse_command(line, origline, need_ack)
+                    cmd = gcmd.get_command()
+                    # Invoke handler for command
+                    handler = self.gcode_handlers.get(cmd, self.cmd_default)
+                    handler(gcmd)
             except self.error as e:
                 if "exclude_object over" not in str(e):   
                     self._respond_error(str(e))
@@ -216,12 +255,23 @@ class GCodeDispatch:
                 self._respond_error(msg)
                 if not need_ack:
                     raise
-            gcmd.ack()
+            finally:
+                # Failed commands are recorded as well
+                if profiler is not None and cmd:
+                    profiler.note_command(cmd, start_time)
+            if gcmd is not None:
+                gcmd.ack()
+            elif need_ack:
+                self.respond_raw("ok")
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_script_lines(self, lines):
+        # Run an iterable of already split lines under one mutex hold
+        with self.mutex:
+            self._process_commands(lines, need_ack=False)
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -19,6 +19,7 @@ class DeltaKinematics:
         # Setup tower rails
         stepper_configs = [config.getsection('stepper_' + a) for a in 'abc']
         self.printer = config.get_printer()#flsun add
+        self.toolhead = toolhead
         rail_a = stepper.LookupMultiRail(
             stepper_configs[0], need_position_minmax = False)
         a_endstop = rail_a.get_homing_info().position_endstop
@@ -65,6 +66,11 @@ class DeltaKinematics:
         self.towers = [(math.cos(math.radians(angle)) * radius,
                         math.sin(math.radians(angle)) * radius)
                        for angle in self.angles]
+        # Tower x, y, arm length squared and maximum carriage height
+        self.tower_limits = [
+            (t[0], t[1], arm2, abs_endstop + 0.01)
+            for t, arm2, abs_endstop in zip(self.towers, self.arm2,
+                                            self.abs_endstops)]
         for r, a, t in zip(self.rails, self.arm2, self.towers):
             r.setup_itersolve('delta_stepper_alloc', a, t[0], t[1])
         for s in self.get_steppers():
@@ -148,38 +154,51 @@ class DeltaKinematics:
     def check_move(self, move):
         end_pos = move.end_pos
         end_xy2 = end_pos[0]**2 + end_pos[1]**2
-        if end_xy2 <= self.limit_xy2 and not move.axes_d[2]:
-            # Normal XY move
-            return
+        if end_xy2 <= self.limit_xy2:
+            if not move.axes_d[2]:
+                # Normal XY move
+                return
+            if self.normal_min_z <= end_pos[2] <= self.limit_z:
+                # Z move (eg, bed mesh adjusted) inside the safe region
+                z_ratio = move.move_d / abs(move.axes_d[2])
+                move.limit_speed(self.max_z_velocity * z_ratio,
+                                 self.max_z_accel * z_ratio)
+                return
         if self.need_home:
             raise move.move_error("Must home first")
         end_z = end_pos[2]
         limit_xy2 = self.max_xy2
         #if end_z > self.limit_z:
         #    limit_xy2 = min(limit_xy2, (self.max_z - end_z)**2)
-        toolhead = self.printer.lookup_object('toolhead')
+        is_drip = self.toolhead.special_queuing_state == "Drip"
         if end_xy2 > limit_xy2 or end_z > self.max_z or end_z < self.min_z \
-            or (toolhead.special_queuing_state != "Drip" and end_z < self.normal_min_z):
+            or (not is_drip and end_z < self.normal_min_z):
             # Move out of range - verify not a homing move
             if (end_pos[:2] != self.home_position[:2]
                 or end_z < self.min_z
-                or (toolhead.special_queuing_state != "Drip" and end_z < self.normal_min_z)
+                or (not is_drip and end_z < self.normal_min_z)
                 or end_z > self.home_position[2]):
                 raise move.move_error()
             limit_xy2 = -1.
         if end_z > self.limit_z:
-            ha = math.sqrt(self.arm2[0] - (end_pos[0] - self.towers[0][0])**2 - (end_pos[1] - self.towers[0][1])**2) + end_pos[2]
-            hb = math.sqrt(self.arm2[1] - (end_pos[0] - self.towers[1][0])**2 - (end_pos[1] - self.towers[1][1])**2) + end_pos[2]
-            hc = math.sqrt(self.arm2[2] - (end_pos[0] - self.towers[2][0])**2 - (end_pos[1] - self.towers[2][1])**2) + end_pos[2]    
-            if ha > (self.abs_endstops[0] + 0.01) or hb > (self.abs_endstops[1] +0.01) or hc > (self.abs_endstops[2] +0.01):
-                logging.warning("ha is %f, hb is %f, hc is %f ,abs_endstop is %s", ha, hb, hc, str(self.abs_endstops))
-                raise move.move_error()
+            heights = [math.sqrt(arm2 - (end_pos[0] - tx)**2
+                                 - (end_pos[1] - ty)**2) + end_z
+                       for tx, ty, arm2, max_h in self.tower_limits]
+            for h, limits in zip(heights, self.tower_limits):
+                if h > limits[3]:
+                    logging.warning(
+                        "ha is %f, hb is %f, hc is %f ,abs_endstop is %s",
+                        heights[0], heights[1], heights[2],
+                        str(self.abs_endstops))
+                    raise move.move_error()
             limit_xy2 = -1.
         if move.axes_d[2]:
             z_ratio = move.move_d / abs(move.axes_d[2])
             move.limit_speed(self.max_z_velocity * z_ratio,
                              self.max_z_accel * z_ratio)
-            limit_xy2 = -1.
+            if end_z < self.normal_min_z:
+                # Only the fast path Z range is checked for later moves
+                limit_xy2 = -1.
         # Limit the speed/accel of this move if is is at the extreme
         # end of the build envelope
         extreme_xy2 = max(end_xy2, move.start_pos[0]**2 + move.start_pos[1]**2)
@@ -248,6 +267,18 @@ class DeltaCalibration:
             for sd, t, es, sp in zip(self.stepdists, self.towers,
                                      self.abs_endstops, stable_position) ]
         return mathutil.trilateration(sphere_coords, [a**2 for a in self.arms])
+    def get_positions_from_stable(self, stable_positions):
+        # Return an array of cartesian coordinates for an array of
+        # stable_positions (requires numpy)
+        np = mathutil.numpy
+        spos = np.asarray(stable_positions, dtype=float)
+        sphere_coords = [
+            np.column_stack((np.full(len(spos), t[0]), np.full(len(spos), t[1]),
+                             es - spos[:, i] * sd))
+            for i, (sd, t, es) in enumerate(zip(self.stepdists, self.towers,
+                                                self.abs_endstops)) ]
+        return mathutil.trilateration_array(sphere_coords,
+                                            [a**2 for a in self.arms])
     def calc_stable_position(self, coord):
         # Return a stable_position from a cartesian coordinate
         steppos = [
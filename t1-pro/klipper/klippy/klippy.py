@@ -242,6 +242,10 @@ class Printer:
             logging.info(info)
         if self.bglogger is not None:
             self.bglogger.set_rollover_info(name, info)
+    def get_log_stats(self):
+        if self.bglogger is None:
+            return {}
+        return self.bglogger.get_stats()
     def invoke_shutdown(self, msg):
         if self.in_shutdown_state:
             return
@@ -3,9 +3,14 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, multiprocessing, traceback
+import math, logging, multiprocessing, traceback, time
 import queuelogger
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 ######################################################################
 # Coordinate descent
@@ -13,15 +18,21 @@ import queuelogger
 
 # Helper code that implements coordinate descent
 def coordinate_descent(adj_params, params, error_func):
+    return coordinate_descent_stats(adj_params, params, error_func)[0]
+
+# Coordinate descent returning the best params and convergence stats
+def coordinate_descent_stats(adj_params, params, error_func):
+    start_time = time.time()
     # Define potential changes
     params = dict(params)
     dp = {param_name: 1. for param_name in adj_params}
     # Calculate the error
-    best_err = error_func(params)
+    best_err = initial_err = error_func(params)
     logging.info("Coordinate descent initial error: %s", best_err)
 
     threshold = 0.00001
     rounds = 0
+    evaluations = 1
 
     while sum(dp.values()) > threshold and rounds < 10000:
         rounds += 1
@@ -29,6 +40,7 @@ def coordinate_descent(adj_params, params, error_func):
             orig = params[param_name]
             params[param_name] = orig + dp[param_name]
             err = error_func(params)
+            evaluations += 1
             if err < best_err:
                 # There was some improvement
                 best_err = err
@@ -36,6 +48,7 @@ def coordinate_descent(adj_params, params, error_func):
                 continue
             params[param_name] = orig - dp[param_name]
             err = error_func(params)
+            evaluations += 1
             if err < best_err:
                 # There was some improvement
                 best_err = err
@@ -45,42 +58,152 @@ def coordinate_descent(adj_params, params, error_func):
             dp[param_name] *= 0.9
     logging.info("Coordinate descent best_err: %s  rounds: %d",
                  best_err, rounds)
-    return params
+    stats = {'solver': 'coordinate_descent', 'initial_error': initial_err,
+             'error': best_err, 'iterations': rounds,
+             'evaluations': evaluations,
+             'converged': sum(dp.values()) <= threshold,
+             'duration': time.time() - start_time}
+    return params, stats
 
-# Helper to run the coordinate descent function in a background
-# process so that it does not block the main thread.
-def background_coordinate_descent(printer, adj_params, params, error_func):
-    parent_conn, child_conn = multiprocessing.Pipe()
-    def wrapper():
+# Levenberg-Marquardt least squares (requires numpy).  The
+# residual_func returns the list of residuals for the given params and
+# the error is their sum of squares.  Returns the best params and
+# convergence stats.
+def levenberg_marquardt(adj_params, params, residual_func,
+                        max_iterations=200):
+    np = numpy
+    start_time = time.time()
+    params = dict(params)
+    evaluations = [0]
+    def calc_residuals(x):
+        for param_name, val in zip(adj_params, x):
+            params[param_name] = float(val)
+        evaluations[0] += 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = np.asarray(residual_func(params), dtype=float)
+        err = res.dot(res)
+        if not np.isfinite(err):
+            err = float('inf')
+        return res, err
+    x = np.array([params[param_name] for param_name in adj_params])
+    res, err = calc_residuals(x)
+    initial_err = err
+    logging.info("Levenberg-Marquardt initial error: %s", err)
+    damping = 1e-3
+    iterations = 0
+    converged = False
+    while iterations < max_iterations and np.isfinite(err):
+        iterations += 1
+        # Forward difference jacobian
+        jac = np.empty((len(res), len(x)))
+        for i in range(len(x)):
+            step = 1e-7 * max(1., abs(x[i]))
+            xi = x.copy()
+            xi[i] += step
+            jac[:, i] = (calc_residuals(xi)[0] - res) / step
+        jtj = jac.T.dot(jac)
+        grad = jac.T.dot(res)
+        scale = np.maximum(np.diag(jtj), 1e-12)
+        while damping < 1e12:
+            try:
+                delta = np.linalg.solve(jtj + damping * np.diag(scale), -grad)
+            except np.linalg.LinAlgError:
+                damping *= 10.
+                continue
+            new_res, new_err = calc_residuals(x + delta)
+            if new_err < err:
+                break
+            damping *= 10.
+        else:
+            # No step reduces the error
+            converged = True
+            break
+        x = x + delta
+        improvement = err - new_err
+        res, err = new_res, new_err
+        damping = max(damping * .1, 1e-12)
+        if improvement <= 1e-12 * max(err, 1e-12) or max(abs(delta)) < 1e-9:
+            converged = True
+            break
+    for param_name, val in zip(adj_params, x):
+        params[param_name] = float(val)
+    logging.info("Levenberg-Marquardt best_err: %s  iterations: %d",
+                 err, iterations)
+    stats = {'solver': 'levenberg_marquardt', 'initial_error': initial_err,
+             'error': err, 'iterations': iterations,
+             'evaluations': evaluations[0], 'converged': converged,
+             'duration': time.time() - start_time}
+    return params, stats
+
+# Helper to run functions in background processes so that they do not
+# block the main thread.  At most max_procs of the functions run at the
+# same time.  Returns the list of their results.
+def background_calls(printer, funcs, max_procs=None):
+    if max_procs is None:
+        max_procs = multiprocessing.cpu_count()
+    def wrapper(func, child_conn):
         queuelogger.clear_bg_logging()
         try:
-            res = coordinate_descent(adj_params, params, error_func)
+            res = func()
         except:
             child_conn.send((True, traceback.format_exc()))
             child_conn.close()
             return
         child_conn.send((False, res))
         child_conn.close()
-    # Start a process to perform the calculation
-    calc_proc = multiprocessing.Process(target=wrapper)
-    calc_proc.daemon = True
-    calc_proc.start()
-    # Wait for the process to finish
+    def stop_procs():
+        for idx, calc_proc, parent_conn in running:
+            calc_proc.terminate()
+            calc_proc.join()
+            parent_conn.close()
+    results = [None] * len(funcs)
+    pending = list(enumerate(funcs))
+    running = []
     reactor = printer.get_reactor()
     gcode = printer.lookup_object("gcode")
     eventtime = last_report_time = reactor.monotonic()
-    while calc_proc.is_alive():
+    while pending or running:
+        # Start processes to perform the calculations
+        while pending and len(running) < max_procs:
+            idx, func = pending.pop(0)
+            parent_conn, child_conn = multiprocessing.Pipe()
+            calc_proc = multiprocessing.Process(target=wrapper,
+                                                args=(func, child_conn))
+            calc_proc.daemon = True
+            calc_proc.start()
+            running.append((idx, calc_proc, parent_conn))
+        # Collect results
+        for entry in list(running):
+            idx, calc_proc, parent_conn = entry
+            is_alive = calc_proc.is_alive()
+            if parent_conn.poll():
+                is_err, res = parent_conn.recv()
+            elif not is_alive:
+                is_err, res = True, "process exited without a result"
+            else:
+                continue
+            running.remove(entry)
+            calc_proc.join()
+            parent_conn.close()
+            if is_err:
+                stop_procs()
+                raise Exception("Error in background calculation: %s"
+                                % (res,))
+            results[idx] = res
+        if not running:
+            continue
         if eventtime > last_report_time + 5.:
             last_report_time = eventtime
             gcode.respond_info("Working on calibration...", log=False)
         eventtime = reactor.pause(eventtime + .1)
-    # Return results
-    is_err, res = parent_conn.recv()
-    if is_err:
-        raise Exception("Error in coordinate descent: %s" % (res,))
-    calc_proc.join()
-    parent_conn.close()
-    return res
+    return results
+
+# Helper to run the coordinate descent function in a background
+# process so that it does not block the main thread.
+def background_coordinate_descent(printer, adj_params, params, error_func):
+    def calc():
+        return coordinate_descent(adj_params, params, error_func)
+    return background_calls(printer, [calc])[0]
 
 
 ######################################################################
@@ -112,6 +235,31 @@ def trilateration(sphere_coords, radius2):
     return matrix_add(sphere_coord1, matrix_add(ex_x, matrix_add(ey_y, ez_z)))
 
 
+# Trilateration of arrays of sphere coordinates (one row per point,
+# requires numpy).  Results are nan for spheres that do not intersect.
+def trilateration_array(sphere_coords, radius2):
+    np = numpy
+    sphere_coord1, sphere_coord2, sphere_coord3 = sphere_coords
+    s21 = sphere_coord2 - sphere_coord1
+    s31 = sphere_coord3 - sphere_coord1
+
+    d = np.sqrt((s21**2).sum(axis=1))
+    ex = s21 / d[:, np.newaxis]
+    i = (ex * s31).sum(axis=1)
+    vect_ey = s31 - ex * i[:, np.newaxis]
+    ey = vect_ey / np.sqrt((vect_ey**2).sum(axis=1))[:, np.newaxis]
+    ez = np.cross(ex, ey)
+    j = (ey * s31).sum(axis=1)
+
+    x = (radius2[0] - radius2[1] + d**2) / (2. * d)
+    y = (radius2[0] - radius2[2] - x**2 + (x-i)**2 + j**2) / (2. * j)
+    with np.errstate(invalid='ignore'):
+        z = -np.sqrt(radius2[0] - x**2 - y**2)
+
+    return (sphere_coord1 + ex * x[:, np.newaxis] + ey * y[:, np.newaxis]
+            + ez * z[:, np.newaxis])
+
+
 ######################################################################
 # Matrix helper functions for 3x1 matrices
 ######################################################################
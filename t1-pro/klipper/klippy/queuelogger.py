@@ -3,20 +3,43 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, queue, time
+import logging, logging.handlers, threading, collections, time
+
+# Maximum number of records formatted into a single write
+MAX_BATCH = 1000
+# Time between reports of a message that keeps repeating
+REPEAT_REPORT_TIME = 30.
+# Number of modules listed in the log rollover header
+ROLLOVER_TOP_MODULES = 10
+
+# Argument types that can't change before the background thread
+# formats the message
+IMMUTABLE_TYPES = (str, int, float, bool, type(None), bytes)
+
+def _has_immutable_args(args):
+    if type(args) is dict:
+        args = args.values()
+    for arg in args:
+        if type(arg) not in IMMUTABLE_TYPES:
+            return False
+    return True
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
-    def __init__(self, queue):
+    def __init__(self, listener):
         logging.Handler.__init__(self)
-        self.queue = queue
+        self.listener = listener
+        self.exc_formatter = logging.Formatter()
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
-            self.queue.put_nowait(record)
+            if record.args and not _has_immutable_args(record.args):
+                record.msg = record.getMessage()
+                record.args = None
+            if record.exc_info:
+                record.exc_text = self.exc_formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.listener.queue_record(record)
         except Exception:
             self.handleError(record)
 
@@ -28,19 +51,93 @@ class QueueListener(logging.handlers.RotatingFileHandler):
         #     self, filename, when='midnight', backupCount=5)
         logging.handlers.RotatingFileHandler.__init__(
             self, filename, maxBytes=50 * 1024 * 1024, backupCount=3)
-        self.bg_queue = queue.Queue()
+        # Records are passed in a deque (appends and pops are atomic) and
+        # the event is only set when the background thread may be waiting
+        self.bg_queue = collections.deque()
+        self.bg_event = threading.Event()
+        self.rollover_info = {}
+        self.module_counts = {}
+        self.repeat_key = None
+        self.repeat_count = self.suppressed_count = 0
+        self.repeat_time = 0.
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
-        self.rollover_info = {}
+    def queue_record(self, record):
+        self.bg_queue.append(record)
+        if not self.bg_event.is_set():
+            self.bg_event.set()
     def _bg_thread(self):
+        bg_queue = self.bg_queue
         while 1:
-            record = self.bg_queue.get(True)
-            if record is None:
-                break
-            self.handle(record)
+            self.bg_event.clear()
+            if not bg_queue:
+                self.bg_event.wait()
+                continue
+            records = []
+            while bg_queue and len(records) < MAX_BATCH:
+                record = bg_queue.popleft()
+                if record is None:
+                    self._write_records(records)
+                    self._flush_repeat()
+                    return
+                records.append(record)
+            self._write_records(records)
+    def _make_record(self, msg):
+        return logging.makeLogRecord({'msg': msg, 'levelno': logging.INFO,
+                                      'levelname': 'INFO'})
+    def _repeat_record(self):
+        return self._make_record("Previous message repeated %d times" % (
+            self.repeat_count,))
+    def _flush_repeat(self):
+        if self.repeat_count:
+            self._write_records([self._repeat_record()], check_repeat=False)
+            self.repeat_count = 0
+    def _write_records(self, records, check_repeat=True):
+        counts = self.module_counts
+        out = []
+        for record in records:
+            msg = record.getMessage()
+            record.msg = msg
+            record.args = None
+            if check_repeat:
+                counts[record.module] = counts.get(record.module, 0) + 1
+                # Collapse consecutive copies of the same message
+                key = (record.levelno, msg)
+                if key == self.repeat_key:
+                    self.repeat_count += 1
+                    self.suppressed_count += 1
+                    if record.created < self.repeat_time + REPEAT_REPORT_TIME:
+                        continue
+                    out.append(self.format(self._repeat_record()))
+                    self.repeat_count = 0
+                    self.repeat_time = record.created
+                    continue
+                if self.repeat_count:
+                    out.append(self.format(self._repeat_record()))
+                    self.repeat_count = 0
+                self.repeat_key = key
+                self.repeat_time = record.created
+            out.append(self.format(record))
+        if not out:
+            return
+        data = "\n".join(out) + self.terminator
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if (self.maxBytes > 0
+                and self.stream.tell() + len(data) >= self.maxBytes):
+                self.doRollover()
+            self.stream.write(data)
+            self.flush()
+        except Exception:
+            self.handleError(records[-1])
     def stop(self):
-        self.bg_queue.put_nowait(None)
+        self.queue_record(None)
         self.bg_thread.join()
+    def get_stats(self):
+        return {'module_counts': dict(self.module_counts),
+                'suppressed': self.suppressed_count,
+                'queued': len(self.bg_queue)}
     def set_rollover_info(self, name, info):
         if info is None:
             self.rollover_info.pop(name, None)
@@ -53,11 +150,14 @@ class QueueListener(logging.handlers.RotatingFileHandler):
         logging.handlers.RotatingFileHandler.doRollover(self)
         lines = [self.rollover_info[name]
                  for name in sorted(self.rollover_info)]
+        counts = sorted(self.module_counts.items(),
+                        key=(lambda i: i[1]), reverse=True)
+        lines.append("Log messages by module: %s" % (" ".join(
+            ["%s=%d" % mc for mc in counts[:ROLLOVER_TOP_MODULES]]),))
         lines.append(
             "=============== Log rollover at %s ===============" % (
                 time.asctime(),))
-        self.emit(logging.makeLogRecord(
-            {'msg': "\n".join(lines), 'level': logging.INFO}))
+        self.emit(self._make_record("\n".join(lines)))
 
 MainQueueHandler = None
 
@@ -66,7 +166,7 @@ def setup_bg_logging(filename, debuglevel):
     formatter = logging.Formatter('[%(asctime)s][%(levelname)s]:%(message)s')
     ql = QueueListener(filename)
     ql.setFormatter(formatter)
-    MainQueueHandler = QueueHandler(ql.bg_queue)
+    MainQueueHandler = QueueHandler(ql)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
     root.setLevel(debuglevel)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, bisect
 import greenlet
 import chelper, util
 
@@ -60,6 +60,7 @@ class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
+        self.stats_name = None
 
 class ReactorMutex:
     def __init__(self, reactor, is_locked):
@@ -67,21 +68,31 @@ class ReactorMutex:
         self.is_locked = is_locked
         self.next_pending = False
         self.queue = []
+        # Time spent by callers blocked waiting for the lock
+        self.wait_count = 0
+        self.wait_time = self.max_wait_time = 0.
         self.lock = self.__enter__
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def test_waiting(self):
+        return len(self.queue) > 0
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
             return
         g = greenlet.getcurrent()
         self.queue.append(g)
+        start_time = self.reactor.monotonic()
         while 1:
             self.reactor.pause(self.reactor.NEVER)
             if self.next_pending and self.queue[0] is g:
                 self.next_pending = False
                 self.queue.pop(0)
+                wait_time = self.reactor.monotonic() - start_time
+                self.wait_count += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
                 return
     def __exit__(self, type=None, value=None, tb=None):
         if not self.queue:
@@ -90,6 +101,104 @@ class ReactorMutex:
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+# Histogram bucket limits (in seconds) for timer lateness and callback
+# run times
+STATS_BUCKETS = (.0001, .001, .005, .010, .025, .050, .100, .250, 1.)
+
+# Timing of reactor activity.  Run time is accounted per "slice" - from
+# the start (or resume) of a callback until it returns or pauses.
+class ReactorStats:
+    def __init__(self, reactor):
+        self.monotonic = reactor.monotonic
+        self.current = None
+        self.reset()
+    def reset(self):
+        self.lateness = [0] * (len(STATS_BUCKETS) + 1)
+        self.durations = [0] * (len(STATS_BUCKETS) + 1)
+        self.max_lateness = 0.
+        self.max_lateness_name = None
+        self.callbacks = {}
+        self.fd_count = 0
+        self.fd_latency = self.max_fd_latency = 0.
+        self.pause_count = 0
+        self.pause_time = 0.
+        self.interval_lateness = self.interval_duration = 0.
+        self.interval_name = None
+    def get_name(self, callback):
+        obj = getattr(callback, '__self__', None)
+        if isinstance(obj, ReactorGreenlet):
+            # Resuming a paused callback
+            return obj.stats_name or "greenlet"
+        if isinstance(obj, ReactorCallback):
+            callback = obj.callback
+        return getattr(callback, '__qualname__', None) or repr(callback)
+    def begin(self, name, start_time):
+        self.current = (name, start_time)
+    def end(self):
+        if self.current is None:
+            return None
+        name, start_time = self.current
+        self.current = None
+        duration = self.monotonic() - start_time
+        self.durations[bisect.bisect_left(STATS_BUCKETS, duration)] += 1
+        cb_stats = self.callbacks.get(name)
+        if cb_stats is None:
+            self.callbacks[name] = cb_stats = [0, 0., 0.]
+        cb_stats[0] += 1
+        cb_stats[1] += duration
+        if duration > cb_stats[2]:
+            cb_stats[2] = duration
+        if duration > self.interval_duration:
+            self.interval_duration = duration
+            self.interval_name = name
+        return name
+    def begin_timer(self, callback, waketime):
+        start_time = self.monotonic()
+        name = self.get_name(callback)
+        lateness = start_time - waketime
+        if waketime > _NOW:
+            self.lateness[bisect.bisect_left(STATS_BUCKETS, lateness)] += 1
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+                self.max_lateness_name = name
+            if lateness > self.interval_lateness:
+                self.interval_lateness = lateness
+        self.begin(name, start_time)
+    def run_fd(self, callback, eventtime):
+        start_time = self.monotonic()
+        latency = start_time - eventtime
+        self.fd_count += 1
+        self.fd_latency += latency
+        if latency > self.max_fd_latency:
+            self.max_fd_latency = latency
+        self.begin(self.get_name(callback), start_time)
+        callback(eventtime)
+        self.end()
+    def note_pause(self, pause_time):
+        self.pause_count += 1
+        self.pause_time += pause_time
+    def take_interval(self):
+        res = (self.interval_lateness, self.interval_duration,
+               self.interval_name)
+        self.interval_lateness = self.interval_duration = 0.
+        self.interval_name = None
+        return res
+    def get_summary(self):
+        return {
+            'buckets': list(STATS_BUCKETS),
+            'timer_lateness': list(self.lateness),
+            'max_lateness': self.max_lateness,
+            'max_lateness_callback': self.max_lateness_name,
+            'run_time': list(self.durations),
+            'callbacks': {name: {'count': c, 'total': t, 'max': m}
+                          for name, (c, t, m) in self.callbacks.items()},
+            'fd_events': self.fd_count,
+            'fd_latency': self.fd_latency,
+            'max_fd_latency': self.max_fd_latency,
+            'pause_count': self.pause_count,
+            'pause_time': self.pause_time,
+        }
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -112,8 +221,27 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        # Instrumentation
+        self._stats = None
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    # Instrumentation
+    def set_stats_enabled(self, enable):
+        # The timer and pause paths are swapped for measuring versions
+        # only while enabled
+        if enable:
+            if self._stats is None:
+                self._stats = ReactorStats(self)
+            self._check_timers = self._check_timers_stats
+            self.pause = self._pause_stats
+        elif self._stats is not None:
+            self._stats = None
+            del self._check_timers
+            del self.pause
+    def get_stats(self):
+        return self._stats
+    def get_greenlet_counts(self):
+        return len(self._all_greenlets), len(self._greenlets)
     # Timers
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
@@ -160,6 +288,25 @@ class SelectReactor:
                     return 0.
             self._next_timer = min(self._next_timer, waketime)
         return 0.
+    def _check_timers_stats(self, eventtime, busy):
+        if eventtime < self._next_timer:
+            return SelectReactor._check_timers(self, eventtime, busy)
+        stats = self._stats
+        self._next_timer = self.NEVER
+        g_dispatch = self._g_dispatch
+        for t in self._timers:
+            waketime = t.waketime
+            if eventtime >= waketime:
+                t.waketime = self.NEVER
+                stats.begin_timer(t.callback, waketime)
+                t.waketime = waketime = t.callback(eventtime)
+                stats.end()
+                if g_dispatch is not self._g_dispatch:
+                    self._next_timer = min(self._next_timer, waketime)
+                    self._end_greenlet(g_dispatch)
+                    return 0.
+            self._next_timer = min(self._next_timer, waketime)
+        return 0.
     # Callbacks and Completions
     def completion(self):
         return ReactorCompletion(self)
@@ -223,6 +370,16 @@ class SelectReactor:
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
         return eventtime
+    def _pause_stats(self, waketime):
+        stats = self._stats
+        name = stats.end()
+        g = greenlet.getcurrent()
+        if isinstance(g, ReactorGreenlet):
+            g.stats_name = name
+        start_time = self.monotonic()
+        eventtime = SelectReactor.pause(self, waketime)
+        stats.note_pause(self.monotonic() - start_time)
+        return eventtime
     def _end_greenlet(self, g_old):
         # Cache this greenlet for later use
         self._greenlets.append(g_old)
@@ -254,7 +411,10 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.callback(eventtime)
+                if self._stats is None:
+                    fd.callback(eventtime)
+                else:
+                    self._stats.run_fd(fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -313,7 +473,10 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._stats is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._stats.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -350,7 +513,10 @@ class EPollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._stats is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._stats.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -113,9 +113,23 @@ class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        # Junction limits of the queued moves, kept in parallel arrays so
+        # that the flush pass does not need to read Move attributes
+        self.max_start_v2 = []
+        self.delta_v2 = []
+        self.max_smoothed_v2 = []
+        self.smooth_delta_v2 = []
+        self.max_cruise_v2 = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+    def _trim(self, count):
+        del self.queue[:count]
+        del self.max_start_v2[:count]
+        del self.delta_v2[:count]
+        del self.max_smoothed_v2[:count]
+        del self.smooth_delta_v2[:count]
+        del self.max_cruise_v2[:count]
     def reset(self):
-        del self.queue[:]
+        self._trim(len(self.queue))
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
@@ -128,45 +142,63 @@ class MoveQueue:
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
+        max_start_v2 = self.max_start_v2
+        delta_v2 = self.delta_v2
+        max_smoothed_v2 = self.max_smoothed_v2
+        smooth_delta_v2 = self.smooth_delta_v2
+        max_cruise_v2 = self.max_cruise_v2
         # Traverse queue from last to first move and determine maximum
         # junction speed assuming the robot comes to a complete stop
-        # after the last move.
+        # after the last move.  The comparisons below are min() written
+        # out, keeping the first argument on ties.
         delayed = []
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
         for i in range(flush_count-1, -1, -1):
-            move = queue[i]
-            reachable_start_v2 = next_end_v2 + move.delta_v2
-            start_v2 = min(move.max_start_v2, reachable_start_v2)
-            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
-            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            reachable_start_v2 = next_end_v2 + delta_v2[i]
+            start_v2 = max_start_v2[i]
+            if reachable_start_v2 < start_v2:
+                start_v2 = reachable_start_v2
+            reachable_smoothed_v2 = next_smoothed_v2 + smooth_delta_v2[i]
+            smoothed_v2 = max_smoothed_v2[i]
             if smoothed_v2 < reachable_smoothed_v2:
                 # It's possible for this move to accelerate
-                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                if (smoothed_v2 + smooth_delta_v2[i] > next_smoothed_v2
                     or delayed):
                     # This move can decelerate or this is a full accel
                     # move after a full decel move
                     if update_flush_count and peak_cruise_v2:
                         flush_count = i
                         update_flush_count = False
-                    peak_cruise_v2 = min(move.max_cruise_v2, (
-                        smoothed_v2 + reachable_smoothed_v2) * .5)
+                    peak_cruise_v2 = max_cruise_v2[i]
+                    mid_v2 = (smoothed_v2 + reachable_smoothed_v2) * .5
+                    if mid_v2 < peak_cruise_v2:
+                        peak_cruise_v2 = mid_v2
                     if delayed:
                         # Propagate peak_cruise_v2 to any delayed moves
                         if not update_flush_count and i < flush_count:
                             mc_v2 = peak_cruise_v2
-                            for m, ms_v2, me_v2 in reversed(delayed):
-                                mc_v2 = min(mc_v2, ms_v2)
-                                m.set_junction(min(ms_v2, mc_v2), mc_v2
-                                               , min(me_v2, mc_v2))
+                            for j, ms_v2, me_v2 in reversed(delayed):
+                                if ms_v2 < mc_v2:
+                                    mc_v2 = ms_v2
+                                queue[j].set_junction(
+                                    mc_v2 if mc_v2 < ms_v2 else ms_v2, mc_v2,
+                                    mc_v2 if mc_v2 < me_v2 else me_v2)
                         del delayed[:]
                 if not update_flush_count and i < flush_count:
-                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
-                                    , move.max_cruise_v2, peak_cruise_v2)
-                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
-                                      , min(next_end_v2, cruise_v2))
+                    cruise_v2 = (start_v2 + reachable_start_v2) * .5
+                    if max_cruise_v2[i] < cruise_v2:
+                        cruise_v2 = max_cruise_v2[i]
+                    if peak_cruise_v2 < cruise_v2:
+                        cruise_v2 = peak_cruise_v2
+                    queue[i].set_junction(
+                        cruise_v2 if cruise_v2 < start_v2 else start_v2,
+                        cruise_v2,
+                        cruise_v2 if cruise_v2 < next_end_v2 else next_end_v2)
             else:
+                if reachable_smoothed_v2 < smoothed_v2:
+                    smoothed_v2 = reachable_smoothed_v2
                 # Delay calculating this move until peak_cruise_v2 is known
-                delayed.append((move, start_v2, next_end_v2))
+                delayed.append((i, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
         if update_flush_count or not flush_count:
@@ -174,12 +206,19 @@ class MoveQueue:
         # Generate step times for all moves ready to be flushed
         self.toolhead._process_moves(queue[:flush_count])
         # Remove processed moves from the queue
-        del queue[:flush_count]
+        self._trim(flush_count)
     def add_move(self, move):
-        self.queue.append(move)
-        if len(self.queue) == 1:
+        queue = self.queue
+        if queue:
+            move.calc_junction(queue[-1])
+        queue.append(move)
+        self.max_start_v2.append(move.max_start_v2)
+        self.delta_v2.append(move.delta_v2)
+        self.max_smoothed_v2.append(move.max_smoothed_v2)
+        self.smooth_delta_v2.append(move.smooth_delta_v2)
+        self.max_cruise_v2.append(move.max_cruise_v2)
+        if len(queue) == 1:
             return
-        move.calc_junction(self.queue[-2])
         self.junction_flush -= move.min_move_t
         if self.junction_flush <= 0.:
             # Enough moves have been queued to reach the target flush time.
@@ -3,7 +3,7 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
+import logging, socket, os, sys, errno, json, collections, struct
 import gcode
 import extras.heaters as heater #flsun add, add heater module
 REQUEST_LOG_SIZE = 20
@@ -26,6 +26,27 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+# Clients may negotiate length-prefixed msgpack framing of the messages
+# sent to them (see set_framing()), if a msgpack encoder is available
+try:
+    import msgspec
+    msgpack_dumps = msgspec.msgpack.Encoder().encode
+except ImportError:
+    try:
+        import msgpack
+        msgpack_dumps = msgpack.packb
+    except ImportError:
+        msgpack_dumps = None
+
+def encode_msgpack_frame(data):
+    payload = msgpack_dumps(data)
+    return struct.pack(">I", len(payload)) + payload
+
+def get_framings():
+    if msgpack_dumps is None:
+        return ["json"]
+    return ["msgpack", "json"]
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -77,6 +98,9 @@ class WebRequest:
     def get_dict(self, item, default=Sentinel):
         return self.get(item, default, types=(dict,))
 
+    def get_list(self, item, default=Sentinel):
+        return self.get(item, default, types=(list,))
+
     def get_method(self):
         return self.method
 
@@ -175,6 +199,8 @@ class ClientConnection:
             self.sock.fileno(), self.process_received)
         self.partial_data = self.send_buffer = b""
         self.is_sending_data = False
+        self.framing = "json"
+        self.encode_message = self._encode_json
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
 
@@ -264,9 +290,30 @@ class ClientConnection:
             return
         self.send(result)
 
-    def send(self, data):
+    def set_framing(self, framing):
+        if framing == self.framing:
+            return
+        # Announce the change in the current framing, so that the client
+        # knows how to decode the messages that follow
+        self.send({'framing': framing})
+        self.framing = framing
+        if framing == "msgpack":
+            self.encode_message = encode_msgpack_frame
+        else:
+            self.encode_message = self._encode_json
+        logging.info("webhooks client %s: Using %s framing",
+                     self.uid, framing)
+
+    def _encode_json(self, data):
         jmsg = json.dumps(data, separators=(',', ':'))
-        self.send_buffer += jmsg.encode() + b"\x03"
+        return jmsg.encode() + b"\x03"
+
+    def send(self, data):
+        self.send_encoded(self.encode_message(data))
+
+    def send_encoded(self, msg):
+        # Send a message produced by encode_message() in the current framing
+        self.send_buffer += msg
         if not self.is_sending_data:
             self.is_sending_data = True
             self.reactor.register_callback(self._do_send)
@@ -305,6 +352,7 @@ class WebHooks:
         self.register_endpoint("emergency_stop", self._handle_estop_request)
         self.register_endpoint("register_remote_method",
                                self._handle_rpc_registration)
+        self.register_endpoint("logger/stats", self._handle_logger_stats)
         self.sconn = ServerSocket(self, printer)
 
     def register_endpoint(self, path, callback):
@@ -343,20 +391,33 @@ class WebHooks:
         web_request.send({'endpoints': list(self._endpoints.keys())})
 
     def _handle_info_request(self, web_request):
+        cconn = web_request.get_client_connection()
         client_info = web_request.get_dict('client_info', None)
         if client_info is not None:
-            web_request.get_client_connection().set_client_info(client_info)
+            cconn.set_client_info(client_info)
+        framings = get_framings()
+        req_framings = web_request.get_list('framing', None)
+        if req_framings is not None:
+            # Use the first supported framing in the client's preference
+            for framing in req_framings:
+                if framing in framings:
+                    cconn.set_framing(framing)
+                    break
         state_message, state = self.printer.get_state_message()
         src_path = os.path.dirname(__file__)
         klipper_path = os.path.normpath(os.path.join(src_path, ".."))
         response = {'state': state, 'state_message': state_message,
                     'hostname': socket.gethostname(),
-                    'klipper_path': klipper_path, 'python_path': sys.executable}
+                    'klipper_path': klipper_path, 'python_path': sys.executable,
+                    'framing': cconn.framing}
         start_args = self.printer.get_start_args()
         for sa in ['log_file', 'config_file', 'software_version', 'cpu_info']:
             response[sa] = start_args.get(sa)
         web_request.send(response)
 
+    def _handle_logger_stats(self, web_request):
+        web_request.send(self.printer.get_log_stats())
+
     def _handle_estop_request(self, web_request):
         self.printer.invoke_shutdown("Shutdown due to webhooks request")
 
@@ -443,13 +504,28 @@ class GCodeHelper:
 
 SUBSCRIPTION_REFRESH_TIME = .25
 
+# Clients subscribed to the same fields, with the same response
+# template and update interval, share the status diff and the encoded
+# message (per framing) sent to them
+class StatusSubscription:
+    def __init__(self, objects, template, interval):
+        self.objects = objects
+        self.template = template
+        self.interval = interval
+        self.next_time = 0.
+        self.clients = []
+        # obj_name -> (status version, status) as last sent
+        self.last_status = {}
+
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
         self.clients = {}
+        self.subscriptions = {}
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.version_cache = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -459,52 +535,97 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _get_status(self, query, obj_name, eventtime):
+        # Objects may provide get_status_version(), which must return a
+        # new value whenever their get_status() result changes.  This
+        # avoids calling get_status() on unchanged objects.
+        res = query.get(obj_name)
+        if res is not None:
+            return res
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            res = (None, {})
+        elif not hasattr(po, 'get_status_version'):
+            res = (None, po.get_status(eventtime))
+        else:
+            version = po.get_status_version()
+            res = self.version_cache.get(obj_name)
+            if res is None or res[0] != version:
+                res = (version, po.get_status(eventtime))
+                self.version_cache[obj_name] = res
+        query[obj_name] = res
+        return res
+    def _update_subscription(self, sub, query, eventtime):
+        last_status = sub.last_status
+        cquery = {}
+        for obj_name, req_items in sub.objects.items():
+            version, res = self._get_status(query, obj_name, eventtime)
+            last = last_status.get(obj_name)
+            last_status[obj_name] = (version, res)
+            if last is not None and version is not None and last[0] == version:
+                # Object reports no change since the last update
+                continue
+            if req_items is None:
+                req_items = list(res.keys())
+                if req_items:
+                    sub.objects[obj_name] = req_items
+            lres = {}
+            if last is not None:
+                lres = last[1]
+            cres = {}
+            for ri in req_items:
+                rd = res.get(ri, None)
+                if rd != lres.get(ri):
+                    cres[ri] = rd
+            if cres:
+                cquery[obj_name] = cres
+        if not cquery:
+            return
+        tmp = dict(sub.template)
+        tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+        msgs = {}
+        for cconn in sub.clients:
+            msg = msgs.get(cconn.framing)
+            if msg is None:
+                msg = msgs[cconn.framing] = cconn.encode_message(tmp)
+            cconn.send_encoded(msg)
     def _do_query(self, eventtime):
-        last_query = self.last_query
         query = self.last_query = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
-                continue
-            # Query each requested printer object
+        # Answer queries (including the initial state of a subscription)
+        for objects, send_func in msglist:
             cquery = {}
-            for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+            for obj_name, req_items in objects.items():
+                version, res = self._get_status(query, obj_name, eventtime)
                 if req_items is None:
                     req_items = list(res.keys())
-                    if req_items:
-                        subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
-            # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
-        if not query:
+                cquery[obj_name] = {ri: res.get(ri, None) for ri in req_items}
+            send_func({'params': {'eventtime': eventtime, 'status': cquery}})
+        # Send changes to subscribed clients
+        for key, sub in list(self.subscriptions.items()):
+            sub.clients = [c for c in sub.clients if not c.is_closed()]
+            if not sub.clients:
+                del self.subscriptions[key]
+                continue
+            if eventtime < sub.next_time:
+                continue
+            # Allow for timer jitter on multiples of the refresh time
+            sub.next_time = eventtime + sub.interval - .010
+            self._update_subscription(sub, query, eventtime)
+        for cconn in [c for c in self.clients if c.is_closed()]:
+            del self.clients[cconn]
+        if not query and not self.subscriptions and not self.pending_queries:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
             return reactor.NEVER
         return eventtime + SUBSCRIPTION_REFRESH_TIME
+    def _remove_client(self, cconn):
+        sub = self.clients.pop(cconn, None)
+        if sub is not None and cconn in sub.clients:
+            sub.clients.remove(cconn)
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -515,14 +636,18 @@ class QueryStatusHelper:
                 for ri in v:
                     if type(ri) != str:
                         raise web_request.error("Invalid argument")
+        interval = web_request.get_float('update_interval',
+                                         SUBSCRIPTION_REFRESH_TIME)
+        if interval < SUBSCRIPTION_REFRESH_TIME:
+            raise web_request.error("Invalid update_interval")
         # Add to pending queries
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
-        if is_subscribe and cconn in self.clients:
-            del self.clients[cconn]
+        if is_subscribe:
+            self._remove_client(cconn)
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((objects, complete.complete))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -531,7 +656,20 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            key = json.dumps([objects, template, interval], sort_keys=True)
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                sub = StatusSubscription(objects, template, interval)
+                self.subscriptions[key] = sub
+                # Start from the state returned to the client above
+                sub.last_status = {n: self.last_query[n] for n in objects
+                                   if n in self.last_query}
+            else:
+                # Resend all fields so the new client can not miss a
+                # change made since the group's last update
+                sub.last_status.clear()
+            sub.clients.append(cconn)
+            self.clients[cconn] = sub
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Compare the python and numpy bed mesh interpolation at common mesh sizes
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+from extras import bed_mesh
+
+# (algorithm, probe count, points per segment)
+MESH_SIZES = [
+    ('lagrange', 5, 2), ('lagrange', 6, 4),
+    ('bicubic', 5, 2), ('bicubic', 7, 4), ('bicubic', 9, 4),
+    ('bicubic', 11, 6), ('bicubic', 15, 8),
+]
+
+def make_params(algo, count, pps):
+    return {'min_x': -130., 'max_x': 130., 'min_y': -130., 'max_y': 130.,
+            'x_count': count, 'y_count': count,
+            'mesh_x_pps': pps, 'mesh_y_pps': pps,
+            'algo': algo, 'tension': .2}
+
+def time_sample(sample_func, z_matrix, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        sample_func(z_matrix)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def run_bench(algo, count, pps, repeat):
+    z_mesh = bed_mesh.ZMesh(make_params(algo, count, pps))
+    z_matrix = [[random.uniform(-.3, .3) for i in range(count)]
+                for j in range(count)]
+    python_func = {'lagrange': z_mesh._sample_lagrange,
+                   'bicubic': z_mesh._sample_bicubic}[algo]
+    python_time = time_sample(python_func, z_matrix, repeat)
+    expected = z_mesh.mesh_matrix
+    numpy_func = {'lagrange': z_mesh._sample_lagrange_numpy,
+                  'bicubic': z_mesh._sample_bicubic_numpy}[algo]
+    numpy_time = time_sample(numpy_func, z_matrix, repeat)
+    max_diff = max([abs(a - b) for r1, r2 in zip(expected, z_mesh.mesh_matrix)
+                    for a, b in zip(r1, r2)])
+    return z_mesh.mesh_x_count, python_time, numpy_time, max_diff
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", default=5,
+                    help="number of runs (the fastest is reported)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if bed_mesh.numpy is None:
+        opts.error("numpy is not installed")
+    random.seed(0)
+    for algo, count, pps in MESH_SIZES:
+        mesh_count, python_time, numpy_time, max_diff = run_bench(
+            algo, count, pps, options.repeat)
+        print("%-8s %2dx%-2d pps=%d (%3dx%-3d mesh): python %8.3fms"
+              "  numpy %7.3fms  (x%.1f, max diff %.1e)" % (
+                  algo, count, count, pps, mesh_count, mesh_count,
+                  python_time * 1000., numpy_time * 1000.,
+                  python_time / numpy_time, max_diff))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Measure G-Code line dispatch throughput on a slicer output file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import gcode
+
+# Minimal printer object - only what GCodeDispatch uses
+class BenchMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type, value, tb):
+        pass
+class BenchReactor:
+    def mutex(self):
+        return BenchMutex()
+class BenchPrinter:
+    def __init__(self):
+        self.reactor = BenchReactor()
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def register_event_handler(self, event, callback):
+        pass
+    def lookup_object(self, name, default=None):
+        return None
+
+# Handlers doing the parameter parsing of the real ones, but nothing else
+class BenchHandlers:
+    def __init__(self):
+        self.count = 0
+    def cmd_move(self, gcmd):
+        params = gcmd.get_command_parameters()
+        for axis in 'XYZEF':
+            if axis in params:
+                float(params[axis])
+        self.count += 1
+    def cmd_arc(self, gcmd):
+        for axis in 'XYZIJEF':
+            gcmd.get_float(axis, None)
+        self.count += 1
+    def cmd_temp(self, gcmd):
+        gcmd.get_float('S', 0.)
+        self.count += 1
+    def cmd_fan(self, gcmd):
+        gcmd.get_float('S', 255., minval=0.)
+        self.count += 1
+    def fast_command(self, params):
+        self.count += 1
+
+def setup_dispatch(use_fast):
+    dispatch = gcode.GCodeDispatch(BenchPrinter())
+    handlers = BenchHandlers()
+    cmds = [('G0', handlers.cmd_move), ('G1', handlers.cmd_move),
+            ('G2', handlers.cmd_arc), ('G3', handlers.cmd_arc),
+            ('M104', handlers.cmd_temp), ('M106', handlers.cmd_fan)]
+    for cmd, func in cmds:
+        dispatch.register_command(cmd, func)
+        if use_fast:
+            dispatch.register_fast_command(cmd, handlers.fast_command)
+    dispatch.cmd_default = (lambda gcmd: None)
+    dispatch._handle_ready()
+    return dispatch, handlers
+
+def run_bench(lines, use_fast, repeat):
+    best = None
+    for i in range(repeat):
+        dispatch, handlers = setup_dispatch(use_fast)
+        start = time.perf_counter()
+        dispatch._process_commands(lines, need_ack=False)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best, handlers.count
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", default=3,
+                    help="number of runs (the fastest is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    with open(args[0], 'r', errors='replace') as f:
+        lines = f.read().split('\n')
+    for name, use_fast in [("regular", False), ("fast path", True)]:
+        duration, count = run_bench(lines, use_fast, options.repeat)
+        print("%-10s %d lines (%d hot) in %.3fs: %.0f lines/sec" % (
+            name, len(lines), count, duration, len(lines) / duration))
+
+if __name__ == '__main__':
+    main()
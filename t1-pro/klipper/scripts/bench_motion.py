@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# Benchmark the host motion pipeline by replaying G-Code files through
+# klippy in batch mode
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, time, json, platform
+import cProfile, pstats
+KLIPPY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'klippy')
+sys.path.append(KLIPPY_DIR)
+import msgproto
+
+DEFAULT_CONFIG = os.path.join(KLIPPY_DIR, '..', 'test', 'klippy',
+                              'motion_bench.cfg')
+REPORT_VERSION = 1
+
+
+######################################################################
+# Stage accounting
+######################################################################
+
+# Stages of the motion pipeline as (name, [(source file, functions)]).
+# A function list of None selects every function of the file not
+# claimed by another stage.  Time spent in the C helpers is counted in
+# the Python function calling them.
+STAGES = [
+    ("gcode", [("gcode.py", None), ("gcode_move.py", None),
+               ("gcode_arcs.py", None)]),
+    ("lookahead", [("toolhead.py", None)]),
+    ("trapq", [("toolhead.py", ["_process_moves"]),
+               ("extruder.py", ["move"])]),
+    ("itersolve", [("stepper.py", ["generate_steps"])]),
+    ("stepcompress", [("mcu.py", ["flush_moves"])]),
+]
+
+def build_stage_lookup():
+    funcs = {}
+    files = {}
+    for name, sources in STAGES:
+        for fname, func_names in sources:
+            if func_names is None:
+                files[fname] = name
+                continue
+            for func_name in func_names:
+                funcs[(fname, func_name)] = name
+    return funcs, files
+
+def summarize_profile(stats_fname):
+    stats = pstats.Stats(stats_fname)
+    funcs, files = build_stage_lookup()
+    def get_stage(fname, func_name):
+        base = os.path.basename(fname)
+        return funcs.get((base, func_name), files.get(base))
+    stage_times = {name: 0. for name, sources in STAGES}
+    total = moves = 0.
+    for (fname, line, func_name), info in stats.stats.items():
+        cc, ncalls, tottime, cumtime, callers = info
+        total += tottime
+        if fname == "~":
+            # Builtins (math, list methods, ...) count for their callers
+            for (cfname, cline, cfunc_name), cinfo in callers.items():
+                stage = get_stage(cfname, cfunc_name)
+                if stage is not None:
+                    stage_times[stage] += cinfo[2]
+            continue
+        if os.path.basename(fname) == "toolhead.py" and func_name == "move":
+            moves += ncalls
+        stage = get_stage(fname, func_name)
+        if stage is not None:
+            stage_times[stage] += tottime
+    stage_times["other"] = total - sum(stage_times.values())
+    return stage_times, int(moves)
+
+
+######################################################################
+# Batch output decoding
+######################################################################
+
+# Sum of the queue_step counts sent to the (main) mcu
+def count_steps(output_fname, dict_fname):
+    f = open(dict_fname, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    queue_step = mp.messages_by_name.get('queue_step')
+    f = open(output_fname, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    steps = 0
+    pos = 0
+    while pos + msgproto.MESSAGE_MIN <= len(data):
+        msglen = data[pos + msgproto.MESSAGE_POS_LEN]
+        if msglen < msgproto.MESSAGE_MIN:
+            break
+        block = data[pos:pos + msglen]
+        bpos = msgproto.MESSAGE_HEADER_SIZE
+        while bpos < msglen - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(block[bpos], mp.unknown)
+            params, bpos = mid.parse(block, bpos)
+            if mid is queue_step:
+                steps += params['count']
+        pos += msglen
+    return steps
+
+
+######################################################################
+# Benchmark runs
+######################################################################
+
+class BenchCase:
+    def __init__(self, gcode_fname, options, tempdir):
+        self.gcode_fname = gcode_fname
+        self.options = options
+        self.tempdir = tempdir
+        self.input_fname = gcode_fname
+        self.lines = 0
+    def prepare(self):
+        f = open(self.gcode_fname, 'r', errors='replace')
+        data = f.read()
+        f.close()
+        self.lines = data.count('\n')
+        if self.options.prefix:
+            # Slicer files usually leave homing to the start macro
+            self.input_fname = os.path.join(self.tempdir, "_bench_.gcode")
+            f = open(self.input_fname, 'w')
+            f.write(self.options.prefix.replace('\\n', '\n') + '\n' + data)
+            f.close()
+    def klippy_args(self, output_fname, log_fname):
+        args = [self.options.config, '-i', self.input_fname,
+                '-o', output_fname, '-l', log_fname]
+        for df in self.options.dictionaries:
+            args += ['-d', df]
+        return args
+    def run_klippy(self, profile_fname=None):
+        output_fname = os.path.join(self.tempdir, "_bench_output")
+        log_fname = os.path.join(self.tempdir, "_bench_.log")
+        args = [sys.executable, os.path.realpath(__file__),
+                '--child', profile_fname or ""]
+        args += self.klippy_args(output_fname, log_fname)
+        start_time = time.perf_counter()
+        proc = subprocess.Popen(args)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        duration = time.perf_counter() - start_time
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode:
+            f = open(log_fname, 'r')
+            sys.stdout.write(f.read())
+            f.close()
+            raise Exception("klippy failed on %s" % (self.gcode_fname,))
+        return duration, rusage, output_fname
+    def run(self):
+        self.prepare()
+        main_dict = self.options.dictionaries[0]
+        best = None
+        for i in range(self.options.repeat):
+            duration, rusage, output_fname = self.run_klippy()
+            if best is None or duration < best[0]:
+                best = (duration, rusage)
+        duration, rusage = best
+        steps = count_steps(output_fname, main_dict)
+        profile_fname = os.path.join(self.tempdir, "_bench_.prof")
+        self.run_klippy(profile_fname)
+        stage_times, moves = summarize_profile(profile_fname)
+        return {
+            'file': self.gcode_fname,
+            'lines': self.lines, 'moves': moves, 'steps': steps,
+            'wall_time': duration,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'lines_per_sec': self.lines / duration,
+            'moves_per_sec': moves / duration,
+            'steps_per_sec': steps / duration,
+            'peak_rss_kb': rusage.ru_maxrss,
+            'stage_cpu_time': stage_times,
+        }
+
+# Runs klippy in the benchmark child process (optionally under cProfile
+# with a cpu time clock)
+def run_child(profile_fname, klippy_args):
+    import klippy
+    sys.argv = [os.path.join(KLIPPY_DIR, 'klippy.py')] + klippy_args
+    if not profile_fname:
+        klippy.main()
+        return
+    prof = cProfile.Profile(time.process_time)
+    try:
+        prof.runcall(klippy.main)
+    finally:
+        prof.dump_stats(profile_fname)
+
+
+######################################################################
+# Reporting
+######################################################################
+
+def format_result(res):
+    out = ["%s:" % (res['file'],)]
+    out.append("  %d lines, %d moves, %d steps in %.3fs (cpu %.3fs)" % (
+        res['lines'], res['moves'], res['steps'], res['wall_time'],
+        res['cpu_time']))
+    out.append("  %.0f lines/sec  %.0f moves/sec  %.0f steps/sec"
+               "  peak rss %.1fMiB" % (
+                   res['lines_per_sec'], res['moves_per_sec'],
+                   res['steps_per_sec'], res['peak_rss_kb'] / 1024.))
+    stages = res['stage_cpu_time']
+    total = sum(stages.values())
+    parts = ["%s=%.3fs(%.0f%%)" % (name, t, 100. * t / total)
+             for name, t in stages.items() if total]
+    out.append("  profiled cpu: " + " ".join(parts))
+    return "\n".join(out)
+
+def check_baseline(results, baseline_fname, max_regression):
+    f = open(baseline_fname, 'r')
+    baseline = json.load(f)
+    f.close()
+    old_results = {os.path.basename(r['file']): r
+                   for r in baseline.get('results', [])}
+    regressions = []
+    for res in results:
+        old = old_results.get(os.path.basename(res['file']))
+        if old is None:
+            continue
+        for key in ['lines_per_sec', 'steps_per_sec']:
+            if not old[key]:
+                continue
+            change = 100. * (res[key] - old[key]) / old[key]
+            if change < -max_regression:
+                regressions.append("%s: %s %.0f -> %.0f (%.1f%%)" % (
+                    res['file'], key, old[key], res[key], change))
+    return regressions
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3:])
+        return
+    usage = "%prog [options] <gcode files>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", dest="config", default=DEFAULT_CONFIG,
+                    help="printer config file")
+    opts.add_option("-d", "--dictionary", dest="dictionaries",
+                    action="append", default=[],
+                    help="mcu data dictionary (repeat as mcu=file for"
+                    " secondary mcus)")
+    opts.add_option("-p", "--prefix", dest="prefix", default="G28",
+                    help="G-Code run before each file (\\n separated)")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=1,
+                    help="timing runs per file (the fastest is reported)")
+    opts.add_option("-o", "--output", dest="output",
+                    help="write a JSON report to this file")
+    opts.add_option("-b", "--baseline", dest="baseline",
+                    help="JSON report to compare against")
+    opts.add_option("-m", "--max-regression", dest="max_regression",
+                    type="float", default=10.,
+                    help="allowed throughput loss vs the baseline (percent)")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    if not options.dictionaries:
+        opts.error("A data dictionary file must be specified")
+
+    results = []
+    tempdir = tempfile.mkdtemp(prefix="bench_motion_")
+    for fname in args:
+        res = BenchCase(fname, options, tempdir).run()
+        sys.stdout.write(format_result(res) + "\n")
+        results.append(res)
+    for fname in os.listdir(tempdir):
+        os.unlink(os.path.join(tempdir, fname))
+    os.rmdir(tempdir)
+
+    if options.output:
+        report = {'version': REPORT_VERSION, 'config': options.config,
+                  'dictionaries': options.dictionaries,
+                  'python': sys.version, 'machine': platform.machine(),
+                  'results': results}
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=2)
+        f.close()
+    if options.baseline:
+        regressions = check_baseline(results, options.baseline,
+                                     options.max_regression)
+        if regressions:
+            sys.stdout.write("Regressions:\n  %s\n" % (
+                "\n  ".join(regressions),))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@
 
 from __future__ import annotations
 from ..utils import Sentinel
+from ..utils import json_wrapper as jsonw
 from ..common import WebRequest, Subscribable
 
 # Annotation imports
@@ -189,6 +190,9 @@ class KlippyAPI(Subscribable):
         if send_id:
             ver = self.version
             params = {'client_info': {'program': "Moonraker", 'version': ver}}
+            if jsonw.MSGPACK_ENABLED:
+                # Klippy falls back to JSON if it can't encode msgpack
+                params['framing'] = ["msgpack", "json"]
         return await self._send_klippy_request(INFO_ENDPOINT, params, default)
 
     async def get_object_list(self,
@@ -164,9 +164,16 @@ class KlippyConnection:
 
     async def _read_stream(self, reader: asyncio.StreamReader) -> None:
         errors_remaining: int = 10
+        # Klippy sends JSON until it announces a negotiated framing
+        use_msgpack: bool = False
         while not reader.at_eof():
             try:
-                data = await reader.readuntil(b'\x03')
+                if use_msgpack:
+                    header = await reader.readexactly(4)
+                    data = await reader.readexactly(
+                        int.from_bytes(header, "big"))
+                else:
+                    data = await reader.readuntil(b'\x03')
             except (ConnectionError, asyncio.IncompleteReadError):
                 break
             except asyncio.CancelledError:
@@ -180,11 +187,20 @@ class KlippyConnection:
                 continue
             errors_remaining = 10
             try:
-                decoded_cmd = jsonw.loads(data[:-1])
+                if use_msgpack:
+                    decoded_cmd = jsonw.msgpack_loads(data)
+                else:
+                    decoded_cmd = jsonw.loads(data[:-1])
+                if "framing" in decoded_cmd:
+                    use_msgpack = decoded_cmd["framing"] == "msgpack"
+                    logging.info(
+                        f"Klippy Connection: {decoded_cmd['framing']} framing")
+                    continue
                 self._process_command(decoded_cmd)
             except Exception:
+                resp = repr(data) if use_msgpack else data.decode()
                 logging.exception(
-                    f"Error processing Klippy Host Response: {data.decode()}")
+                    f"Error processing Klippy Host Response: {resp}")
         if not self.closing:
             logging.debug("Klippy Disconnection From _read_stream()")
             await self.close()
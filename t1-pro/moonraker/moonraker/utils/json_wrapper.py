@@ -12,6 +12,7 @@ from typing import Any, Union, TYPE_CHECKING
 if TYPE_CHECKING:
     def dumps(obj: Any) -> bytes: ...  # type: ignore # noqa: E704
     def loads(data: Union[str, bytes, bytearray]) -> Any: ...  # noqa: E704
+    def msgpack_loads(data: Union[bytes, bytearray]) -> Any: ...  # noqa: E704
 
 MSGSPEC_ENABLED = False
 _msgspc_var = os.getenv("MOONRAKER_ENABLE_MSGSPEC", "y").lower()
@@ -23,6 +24,9 @@ if _msgspc_var in ["y", "yes", "true"]:
         decoder = msgspec.json.Decoder()
         dumps = encoder.encode  # noqa: F811
         loads = decoder.decode  # noqa: F811
+        # msgspec caches the decoded dict keys, which are mostly repeated
+        # field names
+        msgpack_loads = msgspec.msgpack.Decoder().decode  # noqa: F811
         MSGSPEC_ENABLED = True
 if not MSGSPEC_ENABLED:
     import json
@@ -31,3 +35,14 @@ if not MSGSPEC_ENABLED:
 
     def dumps(obj) -> bytes:  # type: ignore # noqa: F811
         return json.dumps(obj).encode("utf-8")
+
+# Decoding of msgpack messages, used by the Klippy connection when
+# negotiated
+MSGPACK_ENABLED = MSGSPEC_ENABLED
+if not MSGPACK_ENABLED:
+    with contextlib.suppress(ImportError):
+        import msgpack
+
+        def msgpack_loads(data) -> Any:  # type: ignore # noqa: F811
+            return msgpack.unpackb(data, strict_map_key=False)
+        MSGPACK_ENABLED = True
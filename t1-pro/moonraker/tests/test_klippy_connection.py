@@ -5,6 +5,7 @@ import pathlib
 from typing import TYPE_CHECKING, Dict
 from moonraker.server import ServerError
 from moonraker.klippy_connection import KlippyRequest
+from moonraker.utils import json_wrapper as jsonw
 from mocks import MockReader, MockWriter
 
 if TYPE_CHECKING:
@@ -218,6 +219,22 @@ async def test_read_decode_error(base_server: Server,
     await kconn._read_stream(mock_reader)
     assert "Error processing Klippy Host Response:" in caplog.messages[-1]
 
+@pytest.mark.asyncio
+async def test_read_msgpack_framing(base_server: Server):
+    if not jsonw.MSGPACK_ENABLED:
+        pytest.skip("msgpack decoding not available")
+    msgpack = pytest.importorskip("msgpack")
+    req = KlippyRequest("info", {})
+    kconn = base_server.klippy_connection
+    kconn.pending_requests[req.id] = req
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'{"framing":"msgpack"}\x03')
+    payload = msgpack.packb({"id": req.id, "result": {"state": "ready"}})
+    reader.feed_data(len(payload).to_bytes(4, "big") + payload)
+    reader.feed_eof()
+    await kconn._read_stream(reader)
+    assert await req.wait(1.) == {"state": "ready"}
+
 def test_process_unknown_method(base_server: Server,
                                 caplog: pytest.LogCaptureFixture):
     cmd = {"method": "test_unknown"}